@@ -0,0 +1,415 @@
+#!/usr/bin/env python
+
+# A local stand-in for everything the crawler and the download worker talk to,
+# so that they can be run, and timed, without the live Soundcloud API, the
+# control server or the file server:
+#
+#     GET  /tracks                 the search API, with linked_partitioning
+#     GET  /tracks/<id>/download   a redirect to /cdn/<id> on cdn_host
+#     GET  /cdn/<id>               the CDN, synthetic files with a
+#                                  content-disposition, and Range support
+#     GET  /fetch-tasks.php        download tasks for the tracks it serves
+#     POST /insert-filenames.php   filename reports
+#     POST /insert-hashes.php      content hashes
+#     GET  /stats                  what it has served so far
+#
+# The tracks are generated from the settings, the same every run, and each
+# license and day has tracks_per_day tracks, cycling through the list so
+# there are sparse and dense days for shards to merge and split. Settings
+# are the "server" section of bench.yaml, run-bench.py starts it for you but
+# it can also be run on its own:
+#
+#     python bench/mock_server.py --config bench/bench.yaml --port 8000
+
+from __future__ import print_function
+
+import argparse, datetime, hashlib, json, random, threading, time, yaml
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import urlencode
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlencode, urlparse
+
+DATE_START = datetime.datetime(2016, 2, 6)
+
+SQL_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SOUNDCLOUD_DATETIME_FORMAT = '%Y/%m/%d %H:%M:%S +0000'
+
+# Licenses the API answers with a 400, as it does for these on the live API
+BAD_LICENSES = ['no-rights-reserved', 'cc-by-nc']
+
+LICENSES = ['cc-by', 'cc-by-nd', 'cc-by-sa', 'cc-by-nc-nd', 'cc-by-nc-sa']
+
+DEFAULTS = {
+    'seed': 1,
+    'date_start': DATE_START,
+    'days': 7,
+    'licenses': LICENSES,
+    'bad_licenses': BAD_LICENSES,
+    # Cycled through day by day
+    'tracks_per_day': [20, 400, 3000],
+    # Serve search results newest first rather than in the created_at order
+    # asked for
+    'newest_first': False,
+    # Paging past this offset gets a 400, as on the live API
+    'max_offset': 8000,
+    # Milliseconds each API request takes
+    'latency_ms': 50,
+    # Requests per second the API allows before answering 429, 0 for no limit
+    'rate_limit': 0,
+    # Fraction of API requests answered 429 at random, and their Retry-After
+    'throttle_rate': 0.0,
+    'retry_after': 1,
+    # Tracks served by fetch-tasks.php
+    'download_tracks': 200,
+    'tasks_quantity': 50,
+    'file_size_min': 256 * 1024,
+    'file_size_max': 4 * 1024 * 1024,
+    # Redirect downloads from the API to the CDN at cdn_host, as the live API
+    # does, rather than serving them from the API host
+    'redirect_downloads': True,
+    'cdn_host': 'localhost',
+    # Milliseconds before the CDN starts sending
+    'cdn_latency_ms': 20,
+    # Bytes per second for each download, 0 for no limit
+    'cdn_bandwidth': 0
+}
+
+CHUNK_SIZE = 64 * 1024
+
+class Catalogue (object):
+
+    """The synthetic tracks, worked out from the settings rather than stored,
+       so there can be millions of them."""
+
+    def __init__ (self, settings):
+        self.settings = settings
+        self.date_start = settings['date_start']
+        # YAML reads 2016-02-06 as a date
+        if not isinstance(self.date_start, datetime.datetime):
+            self.date_start = datetime.datetime.combine(self.date_start,
+                                                        datetime.time())
+        self.days = settings['days']
+        self.licenses = settings['licenses']
+        self.tracks_per_day = settings['tracks_per_day']
+        if not isinstance(self.tracks_per_day, list):
+            self.tracks_per_day = [self.tracks_per_day]
+
+    def dayTracks (self, day):
+        return self.tracks_per_day[day % len(self.tracks_per_day)]
+
+    def total (self):
+        return sum(self.dayTracks(day) for day in range(self.days)) \
+            * len(self.licenses)
+
+    def trackId (self, license_index, day, index):
+        # Unique as long as there are fewer than a million tracks a day
+        return ((day * len(self.licenses) + license_index) * 1000000) + index + 1
+
+    def search (self, lic, date_from, date_to):
+        """The (day, index, created_at) of each track for the license created
+           between the dates, in created_at order."""
+        if lic not in self.licenses:
+            return []
+        found = []
+        first_day = max(0, (date_from - self.date_start).days)
+        last_day = min(self.days - 1, (date_to - self.date_start).days)
+        for day in range(first_day, last_day + 1):
+            count = self.dayTracks(day)
+            day_start = self.date_start + datetime.timedelta(days=day)
+            for index in range(count):
+                created_at = day_start + datetime.timedelta(
+                    seconds=(index * 86400) // count)
+                if date_from <= created_at <= date_to:
+                    found.append((day, index, created_at))
+        return found
+
+    def track (self, base_url, lic, day, index, created_at):
+        track_id = self.trackId(self.licenses.index(lic), day, index)
+        return {'id': track_id,
+                'kind': 'track',
+                'download_url': "{0}/tracks/{1}/download".format(base_url,
+                                                                 track_id),
+                'license': lic,
+                'permalink_url': "{0}/user{1}/track-{2}".format(
+                    base_url, track_id % 997, track_id),
+                'title': "Track {0}".format(track_id),
+                'description': "Line one\nline two\tfor {0}".format(track_id),
+                'created_at': created_at.strftime(SOUNDCLOUD_DATETIME_FORMAT),
+                'genre': "Genre {0}".format(track_id % 13),
+                'track_type': 'original',
+                'user': {'username': "user{0}".format(track_id % 997)},
+                'label_name': ''}
+
+    def fileSize (self, track_id):
+        return random.Random(track_id).randint(self.settings['file_size_min'],
+                                               self.settings['file_size_max'])
+
+    def fileChunk (self, track_id, start, length):
+        """length bytes of the file from start, the same every time."""
+        block = hashlib.sha1(str(track_id).encode('ascii')).digest() * 512
+        offset = start % len(block)
+        data = block[offset:] + block * (1 + (length // len(block)))
+        return data[:length]
+
+class Stats (object):
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add (self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def snapshot (self):
+        with self.lock:
+            return dict(self.counts)
+
+class MockHandler (BaseHTTPRequestHandler):
+
+    # Keep-alive, as the real servers do
+    protocol_version = 'HTTP/1.1'
+
+    def log_message (self, format, *args):
+        pass
+
+    def respond (self, code, body, headers=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET (self):
+        url = urlparse(self.path)
+        query = dict((key, values[-1])
+                     for (key, values) in parse_qs(url.query).items())
+        parts = [part for part in url.path.split('/') if part]
+        if parts == ['tracks']:
+            self.server.mock.search(self, query)
+        elif len(parts) == 3 and parts[0] == 'tracks' \
+             and parts[2] == 'download':
+            self.server.mock.redirectDownload(self, int(parts[1]))
+        elif len(parts) == 2 and parts[0] == 'cdn':
+            self.server.mock.download(self, int(parts[1]))
+        elif parts == ['fetch-tasks.php'] or parts == ['tasks']:
+            self.server.mock.tasks(self, query)
+        elif parts == ['stats']:
+            self.respond(200, self.server.mock.stats.snapshot())
+        else:
+            self.respond(404, [])
+
+    def do_POST (self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        form = dict((key, values[-1]) for (key, values) in parse_qs(body).items())
+        parts = [part for part in urlparse(self.path).path.split('/') if part]
+        if parts == ['insert-filenames.php']:
+            self.server.mock.insertFilenames(self, form)
+        elif parts == ['insert-hashes.php']:
+            self.server.mock.insertHashes(self, form)
+        else:
+            self.respond(404, [])
+
+class ThreadingHTTPServer (ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+class MockServer (object):
+
+    """The server and the state behind it."""
+
+    def __init__ (self, settings=None, host='127.0.0.1', port=0):
+        self.settings = dict(DEFAULTS)
+        self.settings.update(settings or {})
+        self.catalogue = Catalogue(self.settings)
+        self.stats = Stats()
+        self.random = random.Random(self.settings['seed'])
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.tokens_at = time.time()
+        self.next_task = 0
+        self.hash_owners = {}
+        self.server = ThreadingHTTPServer((host, port), MockHandler)
+        self.server.mock = self
+        self.url = "http://{0}:{1}".format(host, self.server.server_address[1])
+        self.cdn_url = "http://{0}:{1}".format(self.settings['cdn_host'],
+                                               self.server.server_address[1])
+        self.thread = None
+
+    def start (self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop (self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def throttled (self):
+        """Whether to answer this API request with a 429."""
+        with self.lock:
+            if self.random.random() < self.settings['throttle_rate']:
+                return True
+            rate_limit = self.settings['rate_limit']
+            if not rate_limit:
+                return False
+            now = time.time()
+            self.tokens = min(1.0, self.tokens
+                              + (now - self.tokens_at) * rate_limit)
+            self.tokens_at = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+    def search (self, handler, query):
+        self.stats.add('api_requests')
+        time.sleep(self.settings['latency_ms'] / 1000.0)
+        if self.throttled():
+            self.stats.add('api_429')
+            handler.respond(429, {'error': 'Too Many Requests'},
+                            {'Retry-After': str(self.settings['retry_after'])})
+            return
+        lic = query.get('license')
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 50))
+        if lic in self.settings['bad_licenses'] \
+           or offset > self.settings['max_offset']:
+            self.stats.add('api_400')
+            handler.respond(400, {'error': 'Bad Request'})
+            return
+        try:
+            date_from = datetime.datetime.strptime(query['created_at[from]'],
+                                                   SQL_DATETIME_FORMAT)
+            date_to = datetime.datetime.strptime(query['created_at[to]'],
+                                                 SQL_DATETIME_FORMAT)
+        except (KeyError, ValueError):
+            self.stats.add('api_400')
+            handler.respond(400, {'error': 'Bad created_at'})
+            return
+        found = self.catalogue.search(lic, date_from, date_to)
+        if self.settings['newest_first']:
+            found.reverse()
+        page = found[offset:offset + limit]
+        body = {'collection': [self.catalogue.track(self.url, lic, *found_track)
+                               for found_track in page]}
+        if offset + limit < len(found):
+            next_query = dict(query)
+            next_query.pop('client_id', None)
+            next_query['offset'] = offset + limit
+            body['next_href'] = "{0}/tracks?{1}".format(self.url,
+                                                        urlencode(next_query))
+        self.stats.add('api_pages')
+        self.stats.add('api_tracks', len(page))
+        handler.respond(200, body)
+
+    def redirectDownload (self, handler, track_id):
+        if not self.settings['redirect_downloads']:
+            self.download(handler, track_id)
+            return
+        self.stats.add('api_download_redirects')
+        handler.respond(302, [], {'Location': "{0}/cdn/{1}".format(
+            self.cdn_url, track_id)})
+
+    def download (self, handler, track_id):
+        self.stats.add('cdn_requests')
+        time.sleep(self.settings['cdn_latency_ms'] / 1000.0)
+        size = self.catalogue.fileSize(track_id)
+        start = 0
+        status = 200
+        headers = {'Content-Type': 'audio/mpeg',
+                   'Content-Disposition':
+                   'attachment;filename="Track {0}.mp3"'.format(track_id)}
+        requested_range = handler.headers.get('Range', '')
+        if requested_range.startswith('bytes='):
+            start = int(requested_range[len('bytes='):].split('-')[0])
+            if start >= size:
+                handler.respond(416, [], {'Content-Range':
+                                          'bytes */{0}'.format(size)})
+                return
+            status = 206
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start,
+                                                                  size - 1,
+                                                                  size)
+        handler.send_response(status)
+        handler.send_header('Content-Length', str(size - start))
+        for (name, value) in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        bandwidth = self.settings['cdn_bandwidth']
+        position = start
+        while position < size:
+            length = min(CHUNK_SIZE, size - position)
+            handler.wfile.write(self.catalogue.fileChunk(track_id, position,
+                                                         length))
+            position += length
+            self.stats.add('cdn_bytes', length)
+            if bandwidth:
+                time.sleep(float(length) / bandwidth)
+
+    def tasks (self, handler, query):
+        """Download tasks, in the format of fetch-tasks.php, for the first
+           download_tracks tracks of the first license."""
+        quantity = int(query.get('quantity', self.settings['tasks_quantity']))
+        with self.lock:
+            first = self.next_task
+            last = min(first + quantity, self.settings['download_tracks'])
+            self.next_task = last
+        if first >= last:
+            handler.respond(404, [])
+            return
+        self.stats.add('tasks', last - first)
+        per_day = self.catalogue.dayTracks(0)
+        urls = []
+        for task_number in range(first, last):
+            track_id = self.catalogue.trackId(0, task_number // per_day,
+                                              task_number % per_day)
+            urls.append({'id': task_number + 1,
+                         'download_url': "{0}/tracks/{1}/download".format(
+                             self.url, track_id)})
+        handler.respond(200, {'urls': urls,
+                              'config': {'client_id': 'bench'}})
+
+    def insertFilenames (self, handler, form):
+        filenames = json.loads(form.get('filenames', '[]'))
+        self.stats.add('filenames', len(filenames))
+        handler.respond(200, {'inserted': len(filenames)})
+
+    def insertHashes (self, handler, form):
+        hashes = json.loads(form.get('hashes', '[]'))
+        canonical_ids = {}
+        with self.lock:
+            for report in hashes:
+                owner = self.hash_owners.setdefault(report['content_hash'],
+                                                    int(report['track_id']))
+                canonical_ids[str(report['track_id'])] = owner
+        self.stats.add('hashes', len(hashes))
+        handler.respond(200, canonical_ids)
+
+def load_settings (path):
+    with open(path) as config_file:
+        config = yaml.safe_load(config_file) or {}
+    return config.get('server', {})
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a mock Soundcloud.')
+    parser.add_argument('--config', default='bench/bench.yaml')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    mock = MockServer(load_settings(args.config), args.host, args.port)
+    print("Serving on {0}".format(mock.url))
+    mock.server.serve_forever()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# Runs the crawler and the download worker end to end against the mock
+# server in mock_server.py, and reports their throughput and how long each
+# stage of their work takes, so that changes to them can be measured.
+#
+#     crawl     date-worker.py crawls the mock API into a MySQL database
+#               (the one in bench.yaml, whose tables it drops and recreates)
+#     download  worker/worker.py downloads tasks from the mock control server
+#               and CDN and rsyncs them to a local directory. It runs under
+#               Python 2, like the worker does.
+#
+#     python2 bench/run-bench.py --save-baseline    # before a change
+#     python2 bench/run-bench.py                    # after, compared
+#
+# The results are also written as JSON with --output. The baseline is kept in
+# bench/baseline.json along with the settings it was run with; runs on other
+# settings, or another machine, aren't comparable with it.
+
+from __future__ import division, print_function
+
+import argparse, datetime, json, logging, os, platform, shutil, sys
+import tempfile, threading, time, yaml
+
+BENCH_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIRECTORY = os.path.dirname(BENCH_DIRECTORY)
+
+sys.path.insert(0, ROOT_DIRECTORY)
+sys.path.insert(0, BENCH_DIRECTORY)
+
+import mock_server
+
+CONFIG_PATH = os.path.join(BENCH_DIRECTORY, 'bench.yaml')
+BASELINE_PATH = os.path.join(BENCH_DIRECTORY, 'baseline.json')
+
+STAGES = ['crawl', 'download']
+
+PERCENTILES = [50, 90, 99]
+
+# Compared with the baseline, higher is better
+THROUGHPUT_METRICS = ['pages_per_second', 'rows_per_second',
+                      'tracks_per_second', 'mb_per_second']
+
+# Dropped before the crawl
+BENCH_TABLES = ['time_slices', 'soundcloud_tracks_by_date']
+
+def load_script (name, path):
+    """Import one of the repo's scripts, whose names aren't module names."""
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile (ordered, percent):
+    """Nearest rank percentile of an already sorted list."""
+    rank = max(0, int(round(percent / 100.0 * len(ordered))) - 1)
+    return ordered[min(rank, len(ordered) - 1)]
+
+class Timings (object):
+
+    """How long each call to the methods we wrap takes, by stage name."""
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.wrapped = []
+
+    def record (self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def wrap (self, cls, method_name, name):
+        original = cls.__dict__[method_name]
+        timings = self
+        def timed (*args, **kwargs):
+            started = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timings.record(name, time.time() - started)
+        setattr(cls, method_name, timed)
+        self.wrapped.append((cls, method_name, original))
+
+    def unwrap (self):
+        for (cls, method_name, original) in reversed(self.wrapped):
+            setattr(cls, method_name, original)
+        self.wrapped = []
+
+    def count (self, name):
+        return len(self.samples.get(name, []))
+
+    def summary (self):
+        summary = {}
+        for (name, samples) in self.samples.items():
+            ordered = sorted(samples)
+            stage = {'count': len(ordered),
+                     'max_ms': round(ordered[-1] * 1000, 2)}
+            for percent in PERCENTILES:
+                stage['p{0}_ms'.format(percent)] = round(
+                    percentile(ordered, percent) * 1000, 2)
+            summary[name] = stage
+        return summary
+
+def per_second (amount, seconds):
+    return round(amount / seconds, 2) if seconds else 0
+
+def crawl (settings, mock):
+    import mysql.connector
+    setup = load_script('date_setup_db',
+                        os.path.join(ROOT_DIRECTORY, 'date-setup-db.py'))
+    date_worker = load_script('date_worker',
+                              os.path.join(ROOT_DIRECTORY, 'date-worker.py'))
+    import http_pool
+    database = settings['database']
+    crawl_settings = settings.get('crawl', {})
+    connection = mysql.connector.connect(user=database['user'],
+                                         password=database['password'],
+                                         host=database['host'],
+                                         database=database['database'])
+    cursor = connection.cursor()
+    for table in BENCH_TABLES:
+        cursor.execute("DROP TABLE IF EXISTS {0}".format(table))
+    setup.create_tables(cursor)
+    setup.upgrade_tables(cursor)
+    catalogue = mock.catalogue
+    starts = dict((lic, catalogue.date_start) for lic in setup.LICENSES)
+    date_end = catalogue.date_start + datetime.timedelta(days=catalogue.days)
+    shards = setup.insert_shards(cursor, setup.shard_rows(starts, date_end))
+    connection.commit()
+    config = {'database': database,
+              'soundcloud': {'client_id': 'bench',
+                             'api_url': mock.url,
+                             'requests_per_second':
+                             crawl_settings.get('requests_per_second', 10),
+                             'max_requests_per_second':
+                             crawl_settings.get('max_requests_per_second',
+                                                100)},
+              'http': {'pool_maxsize': crawl_settings.get('concurrency', 4)},
+              'worker': {'id': 'bench',
+                         'concurrency': crawl_settings.get('concurrency', 4)}}
+    timings = Timings()
+    # Each request, and each page including waiting out throttling
+    timings.wrap(http_pool.ApiClient, 'get_page', 'api_request')
+    timings.wrap(date_worker.Worker, 'fetch', 'api_page')
+    timings.wrap(date_worker.Worker, 'insertTracks', 'db_insert')
+    timings.wrap(date_worker.Worker, 'claimTasks', 'db_claim')
+    started = time.time()
+    try:
+        date_worker.Crawler(config).go()
+    finally:
+        timings.unwrap()
+    seconds = time.time() - started
+    cursor.execute("SELECT COUNT(*) FROM soundcloud_tracks_by_date")
+    (rows,) = cursor.fetchone()
+    # Shards put aside to retry, or left in progress
+    cursor.execute("SELECT COUNT(*) FROM time_slices"
+                   " WHERE lease_expires IS NOT NULL")
+    (unfinished,) = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    pages = timings.count('db_insert')
+    return {'seconds': round(seconds, 2),
+            'shards': shards,
+            'unfinished_shards': unfinished,
+            'pages': pages,
+            'rows': rows,
+            'expected_rows': catalogue.total(),
+            'pages_per_second': per_second(pages, seconds),
+            'rows_per_second': per_second(rows, seconds),
+            'latency': timings.summary()}
+
+def download (settings, mock):
+    if sys.version_info[0] != 2:
+        print("The download stage needs Python 2, skipping it.")
+        return None
+    worker = load_script('download_worker',
+                         os.path.join(ROOT_DIRECTORY, 'worker', 'worker.py'))
+    work_directory = tempfile.mkdtemp(prefix='soundcloud-bench-')
+    target = os.path.join(work_directory, 'target')
+    os.makedirs(target)
+    config = {'control_server': mock.url,
+              'filename_insert_passkey': 'bench',
+              'download_path': os.path.join(work_directory, 'tracks'),
+              'rsync_remote_path': target + '/',
+              'ssh_key_path': '/dev/null',
+              'journal_path': os.path.join(work_directory, 'tasks.sqlite'),
+              'tasks_quantity': mock.settings['tasks_quantity']}
+    config.update(settings.get('download', {}))
+    timings = Timings()
+    timings.wrap(worker.Worker, 'fetchNewTasks', 'fetch_tasks')
+    timings.wrap(worker.TasksWorker, 'processTrack', 'download')
+    timings.wrap(worker.Uploader, 'deduplicate', 'deduplicate')
+    timings.wrap(worker.Uploader, 'rsync', 'upload')
+    timings.wrap(worker.FilenameReporter, 'send', 'report')
+    bytes_before = mock.stats.snapshot().get('cdn_bytes', 0)
+    # The worker looks for old task caches in the current directory
+    cwd = os.getcwd()
+    os.chdir(work_directory)
+    started = time.time()
+    try:
+        worker.Worker(config).work()
+    finally:
+        seconds = time.time() - started
+        os.chdir(cwd)
+        timings.unwrap()
+    downloaded = mock.stats.snapshot().get('cdn_bytes', 0) - bytes_before
+    uploaded = sum(len(filenames)
+                   for (directory, directories, filenames) in os.walk(target))
+    shutil.rmtree(work_directory)
+    tracks = timings.count('download')
+    return {'seconds': round(seconds, 2),
+            'tracks': tracks,
+            'files_uploaded': uploaded,
+            'bytes': downloaded,
+            'tracks_per_second': per_second(tracks, seconds),
+            'mb_per_second': per_second(downloaded / (1024 * 1024), seconds),
+            'latency': timings.summary()}
+
+def print_results (results):
+    for (stage, result) in sorted(results.items()):
+        if stage not in STAGES or result is None:
+            continue
+        print("\n{0}".format(stage))
+        for (name, value) in sorted(result.items()):
+            if name not in ('latency', 'server'):
+                print("    {0:<20} {1}".format(name, value))
+        print("    {0:<20} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+            'latency', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+        for (name, latency) in sorted(result['latency'].items()):
+            print("    {0:<20} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+                name, latency['count'], latency['p50_ms'], latency['p90_ms'],
+                latency['p99_ms'], latency['max_ms']))
+
+def change (before, after):
+    if not before:
+        return 'n/a'
+    return "{0:+.1f}%".format((after - before) * 100.0 / before)
+
+def compare (results, baseline):
+    if baseline.get('settings') != results['settings']:
+        print("\nThe baseline was run with different settings, not comparing.")
+        return
+    print("\nCompared with the baseline from {0}:".format(baseline['date']))
+    for stage in STAGES:
+        if not (results.get(stage) and baseline.get(stage)):
+            continue
+        print("\n{0}".format(stage))
+        for metric in THROUGHPUT_METRICS:
+            if metric in results[stage]:
+                print("    {0:<20} {1:>10} -> {2:<10} {3}".format(
+                    metric, baseline[stage][metric], results[stage][metric],
+                    change(baseline[stage][metric], results[stage][metric])))
+        for (name, latency) in sorted(results[stage]['latency'].items()):
+            before = baseline[stage]['latency'].get(name)
+            if before:
+                print("    {0:<20} {1:>10} -> {2:<10} {3} (p50 ms)".format(
+                    name, before['p50_ms'], latency['p50_ms'],
+                    change(before['p50_ms'], latency['p50_ms'])))
+
+def main ():
+    parser = argparse.ArgumentParser(description='Benchmark the crawler and '
+                                     'the download worker.')
+    parser.add_argument('--config', default=CONFIG_PATH)
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma separated, from {0}'.format(STAGES))
+    parser.add_argument('--output', help='write the results here as JSON')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose
+                        else logging.WARNING)
+    with open(args.config) as config_file:
+        settings = yaml.safe_load(config_file)
+    stages = [stage for stage in args.stages.split(',') if stage]
+    mock = mock_server.MockServer(settings.get('server')).start()
+    results = {'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'machine': platform.node(),
+               # Dates aren't JSON
+               'settings': json.loads(json.dumps(settings, default=str))}
+    try:
+        for stage in stages:
+            print("Running {0}...".format(stage))
+            if stage == 'crawl':
+                results['crawl'] = crawl(settings, mock)
+            elif stage == 'download':
+                results['download'] = download(settings, mock)
+            else:
+                parser.error("Unknown stage {0}".format(stage))
+    finally:
+        results['server'] = mock.stats.snapshot()
+        mock.stop()
+    print_results(results)
+    print("\nserver {0}".format(json.dumps(results['server'], sort_keys=True)))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print("\nSaved the baseline to {0}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+if __name__ == '__main__':
+    main()
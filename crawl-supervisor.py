@@ -0,0 +1,171 @@
+import argparse, logging, os, signal, subprocess, sys, time, yaml
+
+# Runs several date-worker.py processes on this host and keeps them running,
+# so a crawl scales with the cores and API credentials we have rather than
+# with the VMs we look after. Set supervisor.processes in config.yaml, and
+# list the client_ids to crawl with in soundcloud.client_ids:
+#
+#     python crawl-supervisor.py --processes 8
+#
+# Each process gets its own worker identifier, worker.id then a dash and its
+# index, and a client_id from the pool, round robin. Each client_id has its
+# own rate budget, split between the processes using it. A process that
+# crashes, or exits non-zero because one of its threads failed, is started
+# again after a delay that doubles each time it crashes soon after starting.
+# One that exits cleanly has run out of shards and is left finished; the
+# supervisor exits once they all have.
+
+LOGLEVEL = 25
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'date-worker.py')
+
+PROCESSES = 2
+
+# Seconds to wait before starting a crashed process again
+RESTART_DELAY = 5
+
+# Never wait longer than this
+MAX_RESTART_DELAY = 5 * 60
+
+# A process that ran this long before crashing starts again at RESTART_DELAY
+STABLE_SECONDS = 10 * 60
+
+# Seconds between checks on the processes
+POLL_SECONDS = 1
+
+# Defaults as in date-worker.py
+API_REQUESTS_PER_SECOND = 1.0
+MAX_API_REQUESTS_PER_SECOND = 4.0
+METRICS_PATH = './metrics.json'
+
+def client_id_pool (soundcloud_config):
+    """soundcloud.client_ids, or just soundcloud.client_id."""
+    client_ids = soundcloud_config.get('client_ids')
+    if not client_ids:
+        client_ids = [soundcloud_config['client_id']]
+    return [str(client_id) for client_id in client_ids]
+
+def indexed_path (path, index):
+    """path with the index before its extension, e.g. metrics-3.json"""
+    (root, extension) = os.path.splitext(path)
+    return "{0}-{1}{2}".format(root, index, extension)
+
+class Child (object):
+
+    """One date-worker.py process, and when to start it again."""
+
+    def __init__ (self, index, command):
+        self.index = index
+        self.command = command
+        self.process = None
+        self.started_at = 0
+        self.restart_at = 0
+        self.restart_delay = RESTART_DELAY
+        self.restarts = 0
+        self.finished = False
+
+    def start (self):
+        self.process = subprocess.Popen(self.command)
+        self.started_at = time.time()
+        logging.log(LOGLEVEL, "Started process %s as pid %s", self.index,
+                    self.process.pid)
+
+    def check (self):
+        """Notice if the process has exited, and start it again when due if it
+           crashed. Returns whether it is still to be run."""
+        if self.finished:
+            return False
+        if self.process is None:
+            if time.time() >= self.restart_at:
+                self.restarts += 1
+                self.start()
+            return True
+        status = self.process.poll()
+        if status is None:
+            return True
+        if status == 0:
+            logging.log(LOGLEVEL, "Process %s finished", self.index)
+            self.finished = True
+            return False
+        ran_for = time.time() - self.started_at
+        if ran_for >= STABLE_SECONDS:
+            self.restart_delay = RESTART_DELAY
+        logging.error("Process %s exited with %s after %.0f seconds, "
+                      "restarting in %s seconds", self.index, status, ran_for,
+                      self.restart_delay)
+        self.process = None
+        self.restart_at = time.time() + self.restart_delay
+        self.restart_delay = min(MAX_RESTART_DELAY, self.restart_delay * 2)
+        return True
+
+    def stop (self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait (self):
+        if self.process is not None:
+            self.process.wait()
+
+class Supervisor (object):
+
+    def __init__ (self, config, config_path, processes):
+        worker_config = config['worker']
+        soundcloud_config = config['soundcloud']
+        client_ids = client_id_pool(soundcloud_config)
+        rate = soundcloud_config.get('requests_per_second',
+                                     API_REQUESTS_PER_SECOND)
+        max_rate = soundcloud_config.get('max_requests_per_second',
+                                         max(rate, MAX_API_REQUESTS_PER_SECOND))
+        metrics_path = worker_config.get('metrics_path', METRICS_PATH)
+        self.children = []
+        for index in range(processes):
+            client_id = client_ids[index % len(client_ids)]
+            # Processes on the same client_id share its budget
+            sharing = len(range(index % len(client_ids), processes,
+                                len(client_ids)))
+            command = [sys.executable, WORKER_SCRIPT,
+                       '--config', config_path,
+                       '--worker-id',
+                       "{0}-{1}".format(worker_config['id'], index),
+                       '--client-id', client_id,
+                       '--rate', str(float(rate) / sharing),
+                       '--max-rate', str(float(max_rate) / sharing),
+                       '--metrics-path', indexed_path(metrics_path, index)]
+            self.children.append(Child(index, command))
+
+    def stop (self, signum=None, frame=None):
+        raise KeyboardInterrupt()
+
+    def go (self):
+        logging.log(LOGLEVEL, "Starting %s processes.", len(self.children))
+        signal.signal(signal.SIGTERM, self.stop)
+        try:
+            for child in self.children:
+                child.start()
+            running = self.children
+            while running:
+                time.sleep(POLL_SECONDS)
+                running = [child for child in running if child.check()]
+        except KeyboardInterrupt:
+            logging.log(LOGLEVEL, "Stopping processes.")
+            for child in self.children:
+                child.stop()
+            for child in self.children:
+                child.wait()
+        restarts = sum(child.restarts for child in self.children)
+        logging.log(LOGLEVEL, "Finished, after %s restarts.", restarts)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run and watch over several '
+                                     'crawl processes.')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--processes', type=int,
+                        help='how many to run, by default '
+                             'supervisor.processes')
+    args = parser.parse_args()
+    logging.basicConfig(level=LOGLEVEL)
+    config = yaml.load(open(args.config))
+    processes = args.processes \
+        or config.get('supervisor', {}).get('processes', PROCESSES)
+    Supervisor(config, args.config, processes).go()
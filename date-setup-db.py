@@ -2,15 +2,31 @@ from __future__ import print_function
 
 import mysql.connector
 from mysql.connector import errorcode
-import datetime, yaml
+import datetime, requests, sys, yaml
+
+import http_pool, ratecontrol
 
 # Dates are inclusive
 # https://blog.soundcloud.com/2008/10/17/cc/
 DATE_START = datetime.datetime(2008, 10, 17)
-DATE_END = datetime.datetime.today()
+# Soundcloud's created_at is in UTC. Only days that have ended get shards,
+# a shard for today would be finished before the day was out.
+DATE_END = datetime.datetime.utcnow()
 DATE_STRIDE = datetime.timedelta(days=1)
 DATE_TO_OFFSET = datetime.timedelta(hours=23, minutes=59, seconds=59)
 
+# Incremental crawls start this many hours before the newest track we have
+# for each license, to catch tracks that only became visible after we crawled
+# past them. Override with incremental.trailing_hours
+TRAILING_HOURS = 6
+
+# Tracks without a download url have their ids looked up from the API this
+# many at a time, committing after each batch
+RESOLVE_BATCH_SIZE = 100
+
+# Shards are inserted this many rows per statement
+SHARD_BATCH_SIZE = 1000
+
 LICENSES = [
     # Currently, all no-rights-reserved calls give a 400 response
     #"no-rights-reserved",
@@ -24,24 +40,16 @@ LICENSES = [
     "cc-by-nc-sa"
 ]
 
-CREATES = [
-"""
-CREATE TABLE time_slices (
-       time_slice_id INT           UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
-       date_from     DATETIME      NOT NULL,
-       date_to       DATETIME      NOT NULL,
-       license       CHAR(20)      NOT NULL,
-       worker        VARCHAR(20),
-       next_href     VARCHAR(255)
-);
-""","""
--- We're not worried about url uniqueness as the results should be unique and
--- ordered by date.
-
-
+# Tracks are keyed by Soundcloud's track id, an integer key being much smaller
+# than the permalink url. Tables from before that can be moved over with
+# "date-setup-db.py migrate-track-ids", which looks up the ids of tracks
+# without a download url from the API, so can take a while. It can be stopped
+# and run again.
+CREATE_TRACKS = """
 CREATE TABLE soundcloud_tracks_by_date (
-       id           INT               UNSIGNED AUTO_INCREMENT PRIMARY KEY,
-       permalink_url VARCHAR(255)     UNIQUE NOT NULL,
+       -- Soundcloud's id for the track
+       id           INT               UNSIGNED NOT NULL PRIMARY KEY,
+       permalink_url VARCHAR(255)     NOT NULL,
        download_url VARCHAR(255)      NOT NULL,
        license      CHAR(20)          NOT NULL,
        -- 100 character limit is from the web UI
@@ -56,15 +64,176 @@ CREATE TABLE soundcloud_tracks_by_date (
        -- No limit from web UI, truncate if longer
        label_name   VARCHAR(255)      NOT NULL
 );
+"""
+
+# The newest track crawled for each license, kept up to date by date-worker.py
+CREATE_HIGH_WATER = """
+CREATE TABLE crawl_high_water (
+       license      CHAR(20)          NOT NULL PRIMARY KEY,
+       created_at   DATETIME          NOT NULL
+);
+"""
+
+CREATES = [
+"""
+CREATE TABLE time_slices (
+       time_slice_id INT           UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
+       date_from     DATETIME      NOT NULL,
+       date_to       DATETIME      NOT NULL,
+       license       CHAR(20)      NOT NULL,
+       worker        VARCHAR(20),
+       next_href     VARCHAR(255),
+       -- Fresh shards start out with an expired lease so they can be claimed,
+       -- finished shards have no lease at all.
+       lease_expires DATETIME      DEFAULT '1970-01-01 00:00:01',
+       -- Tracks seen so far, used by the workers to merge sparse shards
+       track_count   INT           UNSIGNED NOT NULL DEFAULT 0,
+       -- Failures in a row, shards that fail are put aside for longer each time
+       retry_count   INT           UNSIGNED NOT NULL DEFAULT 0,
+       INDEX lease_expires_index (lease_expires),
+       INDEX worker_lease_index (worker, lease_expires),
+       -- Makes setup idempotent, and finds each license's latest shard
+       UNIQUE KEY license_date_from (license, date_from)
+);
+""",
+CREATE_TRACKS,
+CREATE_HIGH_WATER
+]
+
+# Bring tables created by earlier versions of this script up to date.
+# Each upgrade is a list of statements, the rest of which only run if the
+# first succeeds, so running this script again is harmless.
+UPGRADES = [
+    [
+"""
+ALTER TABLE time_slices
+    ADD COLUMN lease_expires DATETIME DEFAULT '1970-01-01 00:00:01',
+    ADD INDEX lease_expires_index (lease_expires),
+    ADD INDEX worker_lease_index (worker, lease_expires);
 ""","""
-CREATE INDEX permalink_url_index on soundcloud_tracks_by_date (permalink_url);
+-- Shards that were claimed and have no next_href are finished. Shards that
+-- were in progress keep the expired lease so anyone can pick them up.
+UPDATE time_slices SET lease_expires = NULL
+    WHERE worker IS NOT NULL AND next_href IS NULL;
+"""
+    ],
+    [
+"""
+ALTER TABLE time_slices
+    ADD COLUMN track_count INT UNSIGNED NOT NULL DEFAULT 0,
+    ADD INDEX license_date_index (license, date_from);
+"""
+    ],
+    [
+"""
+ALTER TABLE time_slices DROP INDEX license_date_index;
+""","""
+-- Running earlier versions of this script twice duplicated every shard.
+-- Keep the first of each.
+DELETE duplicate FROM time_slices AS duplicate
+    JOIN time_slices AS original
+    ON duplicate.license = original.license
+       AND duplicate.date_from = original.date_from
+       AND duplicate.time_slice_id > original.time_slice_id;
+""","""
+ALTER TABLE time_slices
+    ADD UNIQUE KEY license_date_from (license, date_from);
+"""
+    ],
+    [
+"""
+ALTER TABLE time_slices
+    ADD COLUMN retry_count INT UNSIGNED NOT NULL DEFAULT 0;
+"""
+    ]
+]
+
+# The Soundcloud id is in the download url, e.g.
+# https://api.soundcloud.com/tracks/123/download
+MIGRATE_TRACK_IDS = [
+"""
+RENAME TABLE soundcloud_tracks_by_date TO soundcloud_tracks_by_date_old;
+""",
+CREATE_TRACKS,
+"""
+INSERT IGNORE INTO soundcloud_tracks_by_date (id, permalink_url, download_url,
+                                              license, title, description,
+                                              created_at, genre, track_type,
+                                              username, label_name)
+    SELECT CAST(SUBSTRING_INDEX(SUBSTRING_INDEX(download_url, '/tracks/', -1),
+                                '/', 1)
+                AS UNSIGNED),
+           permalink_url, download_url, license, title, description,
+           created_at, genre, track_type, username, label_name
+    FROM soundcloud_tracks_by_date_old
+    WHERE download_url LIKE '%/tracks/%';
 """
 ]
 
+SELECT_UNMIGRATED_COUNT = \
+"""SELECT COUNT(*) FROM soundcloud_tracks_by_date_old
+    WHERE download_url NOT LIKE '%/tracks/%'"""
+
+# The rest have their ids resolved from their permalink_url, in its (unique)
+# index order so a run that is stopped carries on where it left off.
+SELECT_UNMIGRATED = \
+"""SELECT permalink_url, download_url, license, title, description,
+       created_at, genre, track_type, username, label_name
+    FROM soundcloud_tracks_by_date_old
+    WHERE download_url NOT LIKE '%%/tracks/%%'
+          AND permalink_url > %(after)s
+    ORDER BY permalink_url
+    LIMIT %(quantity)s"""
+
+INSERT_RESOLVED_TRACK = \
+"""INSERT IGNORE INTO soundcloud_tracks_by_date (id, permalink_url,
+                                                 download_url, license, title,
+                                                 description, created_at,
+                                                 genre, track_type, username,
+                                                 label_name)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+
+DELETE_RESOLVED_TRACK = \
+"""DELETE FROM soundcloud_tracks_by_date_old WHERE permalink_url = %s"""
+
+# Ignore so that existing shards are left as they are
 INSERT_SHARD = \
-"""INSERT INTO time_slices (date_from, date_to, license)
+"""INSERT IGNORE INTO time_slices (date_from, date_to, license)
     VALUES (%(date_from)s, %(date_to)s, %(license)s)"""
 
+SELECT_LATEST_SHARD = \
+"""SELECT date_to FROM time_slices
+    WHERE license = %(license)s
+    ORDER BY date_from DESC
+    LIMIT 1"""
+
+SELECT_HIGH_WATER = \
+"""SELECT created_at FROM crawl_high_water WHERE license = %(license)s"""
+
+# For crawls from before crawl_high_water, a scan of the tracks, done once
+SEED_HIGH_WATER = \
+"""INSERT IGNORE INTO crawl_high_water (license, created_at)
+    SELECT license, MAX(created_at) FROM soundcloud_tracks_by_date
+    WHERE license = %(license)s
+    GROUP BY license"""
+
+# The incremental shard starts at the same time on every run until new tracks
+# move the high-water mark, so if it is already there and finished it is
+# opened again, up to now, as a fresh shard. One that hasn't been claimed yet
+# is just extended, and one that is being crawled is left alone. MySQL assigns
+# these in order, so lease_expires has to come last.
+INSERT_INCREMENTAL_SHARD = \
+"""INSERT INTO time_slices (date_from, date_to, license)
+    VALUES (%(date_from)s, %(date_to)s, %(license)s)
+    ON DUPLICATE KEY UPDATE
+        date_to = IF(lease_expires IS NULL OR worker IS NULL,
+                     VALUES(date_to), date_to),
+        track_count = IF(lease_expires IS NULL, 0, track_count),
+        retry_count = IF(lease_expires IS NULL, 0, retry_count),
+        worker = IF(lease_expires IS NULL, NULL, worker),
+        lease_expires = IF(lease_expires IS NULL, '1970-01-01 00:00:01',
+                           lease_expires)"""
+
 def create_tables (cursor):
     print("Creating:")
     for create in CREATES:
@@ -78,20 +247,171 @@ def create_tables (cursor):
         else:
             print("OK")
 
+def upgrade_tables (cursor):
+    print("Upgrading:")
+    for upgrade in UPGRADES:
+        try:
+            cursor.execute(upgrade[0])
+        except mysql.connector.Error as err:
+            if err.errno in (errorcode.ER_DUP_FIELDNAME,
+                             errorcode.ER_DUP_KEYNAME,
+                             errorcode.ER_CANT_DROP_FIELD_OR_KEY):
+                print("already done.")
+            else:
+                print(err.msg)
+            continue
+        for statement in upgrade[1:]:
+            cursor.execute(statement)
+        print("OK")
+
+def migrate_track_ids (connection, cursor, config):
+    """Move the tracks over to being keyed by Soundcloud id. Running this
+       again carries on resolving the ids of tracks without a download url."""
+    print("Keying tracks by Soundcloud id.")
+    try:
+        cursor.execute(MIGRATE_TRACK_IDS[0])
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_TABLE_EXISTS_ERROR:
+            print("already done.")
+        else:
+            print(err.msg)
+            return
+    else:
+        for statement in MIGRATE_TRACK_IDS[1:]:
+            cursor.execute(statement)
+        connection.commit()
+        print("Track ids have changed, so reset download_ids_offsets.")
+    resolve_track_ids(connection, cursor, config['soundcloud'])
+    cursor.execute(SELECT_UNMIGRATED_COUNT)
+    (unmigrated,) = cursor.fetchone()
+    print("{0} tracks couldn't be resolved, they are left in".format(
+        unmigrated))
+    print("soundcloud_tracks_by_date_old.")
+
+def resolve_track_id (client, rate_limiter, permalink_url):
+    """The id of the track at permalink_url, or None if it has gone."""
+    while True:
+        rate_limiter.acquire()
+        try:
+            track = client.get_page('/resolve', url=permalink_url)
+        except ratecontrol.Throttled as e:
+            rate_limiter.throttled(e.retry_after)
+            continue
+        except requests.HTTPError as e:
+            print("Couldn't resolve {0}: {1}".format(permalink_url, e))
+            return None
+        rate_limiter.succeeded()
+        return track.get('id')
+
+def resolve_track_ids (connection, cursor, soundcloud_config):
+    """Copy over the tracks left in the old table for want of a download
+       url, with the ids the API gives for their permalink_url."""
+    print("Resolving the ids of tracks without a download url.")
+    client = http_pool.ApiClient(soundcloud_config['client_id'],
+                                 http_pool.make_session(),
+                                 soundcloud_config.get('api_url',
+                                                       http_pool.API_URL))
+    rate = soundcloud_config.get('requests_per_second', 1.0)
+    rate_limiter = ratecontrol.AdaptiveRateLimiter(
+        rate, soundcloud_config.get('max_requests_per_second', rate))
+    resolved = 0
+    after = ''
+    while True:
+        cursor.execute(SELECT_UNMIGRATED, {'after': after,
+                                           'quantity': RESOLVE_BATCH_SIZE})
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            track_id = resolve_track_id(client, rate_limiter, row[0])
+            if track_id is not None:
+                cursor.execute(INSERT_RESOLVED_TRACK, (track_id,) + tuple(row))
+                cursor.execute(DELETE_RESOLVED_TRACK, (row[0],))
+                resolved += 1
+        connection.commit()
+        after = rows[-1][0]
+        print("{0} resolved.".format(resolved))
+
 def datetime_py2sql (dt):
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
+def shard_rows (starts, date_end):
+    """Day long shards for each license, from that license's start in
+       starts, for the days that are over by date_end. A start partway
+       through a day, e.g. after an incremental shard, gets a shard for the
+       rest of that day."""
+    day = min(starts.values()).replace(hour=0, minute=0, second=0,
+                                       microsecond=0)
+    while day + DATE_TO_OFFSET < date_end:
+        end_date = day + DATE_TO_OFFSET
+        for lic in LICENSES:
+            if lic in starts and starts[lic] <= end_date:
+                yield {'date_from': max(day, starts[lic]),
+                       'date_to': end_date,
+                       'license': lic}
+        day = day + DATE_STRIDE
+
+def insert_shards (cursor, rows):
+    """Insert the rows SHARD_BATCH_SIZE at a time, returning how many were new."""
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == SHARD_BATCH_SIZE:
+            cursor.executemany(INSERT_SHARD, batch)
+            count += cursor.rowcount
+            batch = []
+    if batch:
+        cursor.executemany(INSERT_SHARD, batch)
+        count += cursor.rowcount
+    return count
+
 def create_shards (cursor):
     print("Initializing time slices.")
-    start_date = DATE_START
-    while start_date < DATE_END:
-        end_date = start_date + DATE_TO_OFFSET
-        for lic in LICENSES:
-            cursor.execute(INSERT_SHARD,
-                           {'date_from': start_date,
-                            'date_to': end_date,
-                            'license': lic})
-        start_date = start_date + DATE_STRIDE
+    starts = dict((lic, DATE_START) for lic in LICENSES)
+    count = insert_shards(cursor, shard_rows(starts, DATE_END))
+    print("{0} time slices.".format(count))
+
+def extend_shards (cursor):
+    """Add shards only for the days after each license's latest shard."""
+    print("Extending time slices.")
+    starts = {}
+    for lic in LICENSES:
+        cursor.execute(SELECT_LATEST_SHARD, {'license': lic})
+        result = cursor.fetchone()
+        if result is None:
+            starts[lic] = DATE_START
+        else:
+            # The second after, the next day unless it was an incremental
+            # shard, which ends whenever it was added
+            starts[lic] = result[0] + datetime.timedelta(seconds=1)
+    count = insert_shards(cursor, shard_rows(starts, DATE_END))
+    print("{0} new time slices.".format(count))
+
+def incremental_shards (cursor, trailing_window):
+    """Add a shard for each license from trailing_window before its newest
+       crawled track until now, so that crawling it costs requests for the
+       new tracks and the trailing window only."""
+    print("Adding incremental time slices.")
+    # Soundcloud's created_at is in UTC
+    date_end = datetime.datetime.utcnow().replace(microsecond=0)
+    count = 0
+    for lic in LICENSES:
+        cursor.execute(SELECT_HIGH_WATER, {'license': lic})
+        result = cursor.fetchone()
+        if result is None:
+            cursor.execute(SEED_HIGH_WATER, {'license': lic})
+            cursor.execute(SELECT_HIGH_WATER, {'license': lic})
+            result = cursor.fetchone()
+        if result is None:
+            print("No {0} tracks yet, crawl them first.".format(lic))
+            continue
+        cursor.execute(INSERT_INCREMENTAL_SHARD,
+                       {'date_from': result[0] - trailing_window,
+                        'date_to': date_end,
+                        'license': lic})
+        count += 1
+    print("{0} incremental time slices.".format(count))
 
 if __name__ == '__main__':
     config = yaml.load(open('config.yaml'))
@@ -101,8 +421,22 @@ if __name__ == '__main__':
                                          host=dbconfig['host'],
                                          database=dbconfig['database'])
     cursor = connection.cursor()
-    create_tables(cursor)
-    create_shards(cursor)
+    # "extend" just tops up the shards, e.g. daily from cron
+    if sys.argv[1:] == ['extend']:
+        extend_shards(cursor)
+    # "incremental" crawls only what's new, e.g. hourly from cron with
+    # date-worker.py straight after it
+    elif sys.argv[1:] == ['incremental']:
+        trailing_hours = config.get('incremental', {}).get('trailing_hours',
+                                                           TRAILING_HOURS)
+        incremental_shards(cursor,
+                           datetime.timedelta(hours=trailing_hours))
+    elif sys.argv[1:] == ['migrate-track-ids']:
+        migrate_track_ids(connection, cursor, config)
+    else:
+        create_tables(cursor)
+        upgrade_tables(cursor)
+        create_shards(cursor)
     connection.commit()
     cursor.close()
     connection.close()
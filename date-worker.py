@@ -1,72 +1,274 @@
-import soundcloud
-import datetime, logging, requests, time, yaml
+import argparse, collections, datetime, logging, random, requests, threading
+import sys, time, yaml
 import mysql.connector
 from mysql.connector import errorcode
+from mysql.connector.constants import ClientFlag
+
+import http_pool, metrics, pagecache, ratecontrol, trackrows
 
 # This is the program that fetches data from soundcloud and saves it to the db.
 # It finds shards that no other instances of this program are downloading
 # then gets the matching results from the flickr api and inserts them.
 # It handles errors a little but do watch the logs.
+# Several shards can be crawled at once in one process (worker.concurrency in
+# config.yaml), each in its own thread, all sharing a single rate limiter.
+# crawl-supervisor.py runs several processes, each with its own client_id.
+# The rate limiter adapts to the API: it speeds up while requests get through
+# and backs off when we're throttled, in which case the page is fetched again.
+# Counters and timings for each stage are written to worker.metrics_path.
+# If worker.page_cache is set, every page is also saved there, and running
+# with --replay inserts the tracks from those pages again without the API.
+# The newest created_at crawled for each license is kept in crawl_high_water,
+# from which "date-setup-db.py incremental" adds the shards for new uploads.
 
 LOGLEVEL = 25
 
-MAX_TRIES = 1
+# A shard that fails is put aside rather than retried on the spot: its lease
+# is pushed back by a backoff that doubles with each failure, and it goes back
+# to the pool, keeping its next_href, for whichever worker is free once the
+# lease expires. Meanwhile this worker carries on with its other shards.
+# Once there is nothing else to claim, workers wait while any shard is still
+# leased, whether put aside or held by another worker, rather than exiting
+# and leaving behind the shards of a worker that dies, or that split late.
+
+# Seconds to put a shard aside for after its first failure
+RETRY_DELAY = 60
+
+# Never put a shard aside for longer than this
+MAX_RETRY_DELAY = 6 * 60 * 60
 
-# Time (seconds) to sleep while waiting to retry. Make it relatively large.
-SLEEP_TIME = 60
+# A bad or revoked client_id gets these. The shard is put aside as usual, and
+# the worker stops, rather than going on to fail every shard it can claim.
+CREDENTIAL_ERROR_STATUSES = (401, 403)
 
 #NOTE: methods beginning "fetch" access the Internet
 #      methods beginning "insert" and "update" access the database
 
 RESULTS_PER_PAGE = 100
 
-# Don't hit the API more often than once per second
-API_HIT_TIME = 1 * 1001
+# Start out hitting the API once per second (per client_id, across all the
+# threads in the process), and speed up to at most MAX_API_REQUESTS_PER_SECOND
+# while we aren't throttled. Override with soundcloud.requests_per_second and
+# soundcloud.max_requests_per_second
+API_REQUESTS_PER_SECOND = 1.0
+MAX_API_REQUESTS_PER_SECOND = 4.0
 
 # Ignore so if we're restarting halfway through a page we just skip already
 # inserted images from the previous run, or for tracks returned by multiple
 # searches.
+# A whole page is inserted at once with executemany, which the connector
+# rewrites into a single multi-row INSERT.
+# Tracks are keyed by their Soundcloud id. Rows are trackrows tuples, so the
+# parameters are positional.
 INSERT_TRACK = \
-"""INSERT IGNORE INTO soundcloud_tracks_by_date (permalink_url, download_url,
-                                                 license, title, description,
-                                                 created_at, genre, track_type,
-                                                 username, label_name)
-    VALUES (%(permalink_url)s, %(download_url)s, %(license)s, %(title)s,
-            %(description)s, %(created_at)s, %(genre)s, %(track_type)s,
-            %(username)s, %(label_name)s);"""
+"""INSERT IGNORE INTO soundcloud_tracks_by_date ({0})
+    VALUES ({1})""".format(', '.join(trackrows.COLUMNS),
+                           ', '.join(['%s'] * len(trackrows.COLUMNS)))
+
+# Kept in the same transaction as the page, so the mark never runs ahead of
+# the tracks actually inserted
+UPDATE_HIGH_WATER = \
+"""INSERT INTO crawl_high_water (license, created_at)
+    VALUES (%(license)s, %(created_at)s)
+    ON DUPLICATE KEY UPDATE
+        created_at = GREATEST(created_at, VALUES(created_at))"""
+
+# Where to write metrics snapshots, override with worker.metrics_path
+METRICS_PATH = './metrics.json'
+
+# Pages are committed this many at a time when replaying
+REPLAY_COMMIT_PAGES = 100
+
+# How many track ids to remember having inserted, so that tracks returned
+# again by overlapping or repeated searches don't go to the database at all.
+SEEN_TRACKS = 250000
+
+# Shards are leased rather than owned: a worker claims a few at a time and
+# keeps renewing their leases while it works on them. If it dies the leases
+# expire and any other worker can claim the shards and carry on from
+# next_href. Fresh shards are created with an already-expired lease, finished
+# shards have a NULL lease, so claiming is just a range scan on the
+# lease_expires index.
+
+# How long a claimed shard is ours without renewing the lease
+LEASE_SECONDS = 10 * 60
+
+# How often to renew the leases on all the shards we hold
+HEARTBEAT_SECONDS = 60
+
+# How many shards to claim at once
+CLAIM_BATCH_SIZE = 5
 
 UPDATE_NEXT_HREF = \
-"""UPDATE time_slices SET next_href=%(next_href)s
-    WHERE time_slice_id=%(time_slice_id)s;"""
+"""UPDATE time_slices SET next_href=%(next_href)s,
+                       track_count = track_count + %(page_tracks)s,
+                       retry_count = 0,
+                       lease_expires = NOW() + INTERVAL %(lease_seconds)s SECOND
+    WHERE time_slice_id=%(time_slice_id)s AND worker = %(my_identifier)s;"""
 
-SELECT_UNFINISHED_TASK = \
-"""SELECT * FROM time_slices
-    WHERE worker = %(my_identifier)s AND next_href IS NOT NULL
-    LIMIT 1;"""
+UPDATE_TASK_FINISHED = \
+"""UPDATE time_slices SET next_href = NULL, lease_expires = NULL
+    WHERE time_slice_id=%(time_slice_id)s AND worker = %(my_identifier)s;"""
 
-# This is actually a canonical use of LAST_INSERT_ID()
-UPDATE_FRESH_TASK = \
+UPDATE_CLAIM_TASKS = \
 """UPDATE time_slices SET worker = %(my_identifier)s,
-                     time_slice_id = LAST_INSERT_ID(time_slice_id)
-    WHERE worker IS NULL
-    LIMIT 1;"""
+                     lease_expires = NOW() + INTERVAL %(lease_seconds)s SECOND
+    WHERE lease_expires < NOW()
+    ORDER BY lease_expires
+    LIMIT %(quantity)s;"""
+
+SELECT_LEASED_TASKS = \
+"""SELECT time_slice_id, date_from, date_to, license, worker, next_href,
+       track_count, retry_count
+    FROM time_slices
+    WHERE worker = %(my_identifier)s AND lease_expires >= NOW()
+    ORDER BY date_from;"""
+
+# Expired but not yet reclaimed leases are renewed too
+UPDATE_HEARTBEAT = \
+"""UPDATE time_slices
+    SET lease_expires = NOW() + INTERVAL %(lease_seconds)s SECOND
+    WHERE worker = %(my_identifier)s AND lease_expires IS NOT NULL;"""
+
+# Hand the shard back, to be claimed again once the delay has passed
+UPDATE_DEFER_TASK = \
+"""UPDATE time_slices SET worker = NULL,
+                       retry_count = retry_count + 1,
+                       lease_expires = NOW() + INTERVAL %(delay)s SECOND
+    WHERE time_slice_id=%(time_slice_id)s AND worker = %(my_identifier)s;"""
+
+# Seconds until the earliest lease runs out on a shard that isn't finished,
+# whether it was put aside or another worker holds it
+SELECT_UNFINISHED_WAIT = \
+"""SELECT TIMESTAMPDIFF(SECOND, NOW(), MIN(lease_expires)) FROM time_slices
+    WHERE lease_expires > NOW();"""
+
+# Shards adapt to the density of uploads as they are crawled. A shard that is
+# still paginating after SPLIT_AFTER_PAGES pages stops there, and the rest of
+# its range is split into fresh shards that other workers can claim in
+# parallel. The rest is after the last track we saw if the pages come oldest
+# first, as we ask them to, or before it if they come newest first. A shard that turns out to have fewer than MERGE_BELOW_TRACKS tracks
+# merges the unclaimed shards that follow it into one, twice its width, so
+# sparse stretches of the timeline take fewer claims and requests. Shards that
+# have been put aside after failing are never merged.
+
+SPLIT_AFTER_PAGES = 10
+
+SPLIT_WAYS = 4
+
+# Don't split into sub-ranges narrower than this
+MIN_SPLIT_SECONDS = 10 * 60
+
+MERGE_BELOW_TRACKS = RESULTS_PER_PAGE
+
+# Don't merge shards into anything wider than this
+MAX_MERGE_WIDTH = datetime.timedelta(days=64)
+
+ONE_SECOND = datetime.timedelta(seconds=1)
+
+# Soundcloud's created_at format, e.g. 2016/02/06 12:34:56 +0000
+SOUNDCLOUD_DATETIME_FORMAT = '%Y/%m/%d %H:%M:%S'
+
+UPDATE_SPLIT_TASK = \
+"""UPDATE time_slices SET date_to = %(date_to)s, next_href = NULL,
+                       lease_expires = NULL
+    WHERE time_slice_id=%(time_slice_id)s AND worker = %(my_identifier)s;"""
+
+# When the pages come newest first, the part already crawled is the end
+UPDATE_SPLIT_TASK_FROM = \
+"""UPDATE time_slices SET date_from = %(date_from)s, next_href = NULL,
+                       lease_expires = NULL
+    WHERE time_slice_id=%(time_slice_id)s AND worker = %(my_identifier)s;"""
+
+INSERT_SPLIT_SHARD = \
+"""INSERT IGNORE INTO time_slices (date_from, date_to, license)
+    VALUES (%(date_from)s, %(date_to)s, %(license)s)"""
+
+SELECT_FOLLOWING_FRESH_TASKS = \
+"""SELECT time_slice_id, date_from, date_to FROM time_slices
+    WHERE license = %(license)s AND date_from > %(date_from)s
+          AND date_from <= %(merge_until)s AND worker IS NULL
+          AND next_href IS NULL AND retry_count = 0
+    ORDER BY date_from
+    FOR UPDATE;"""
+
+UPDATE_MERGED_TASK = \
+"""UPDATE time_slices SET date_to = %(date_to)s
+    WHERE time_slice_id = %(time_slice_id)s;"""
+
+DELETE_MERGED_TASK = \
+"""DELETE FROM time_slices WHERE time_slice_id = %(time_slice_id)s;"""
+
+def parse_created_at (created_at):
+    return datetime.datetime.strptime(created_at[:19],
+                                      SOUNDCLOUD_DATETIME_FORMAT)
+
+class SeenTracks (object):
+
+    """A thread-safe set of the most recently inserted track ids, forgetting
+       the least recently seen once it holds capacity ids."""
+
+    def __init__(self, capacity=SEEN_TRACKS):
+        self.capacity = capacity
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def unseen(self, track_ids):
+        """The ids we haven't seen, marking the ones we have as recent."""
+        unseen = []
+        with self.lock:
+            for track_id in track_ids:
+                if track_id in self.ids:
+                    self.ids[track_id] = self.ids.pop(track_id)
+                else:
+                    unseen.append(track_id)
+        return unseen
+
+    def add(self, track_ids):
+        with self.lock:
+            for track_id in track_ids:
+                self.ids[track_id] = True
+            while len(self.ids) > self.capacity:
+                self.ids.popitem(last=False)
+
+class LeaseLost (Exception):
 
-SELECT_FRESH_TASK = \
-"""SELECT * FROM time_slices WHERE time_slice_id = LAST_INSERT_ID();"""
+    """Another worker reclaimed the shard we were working on."""
+
+    pass
 
 class Worker (object):
 
-    def __init__(self, config):
-        self.identifier = config['worker']['id']
+    def __init__(self, config, rate_limiter, identifier=None, session=None,
+                 seen_tracks=None, stats=None, page_cache=None):
+        if identifier is None:
+            identifier = config['worker']['id']
+        self.identifier = identifier
+        self.rate_limiter = rate_limiter
+        if seen_tracks is None:
+            seen_tracks = SeenTracks()
+        self.seen_tracks = seen_tracks
+        if stats is None:
+            stats = metrics.Metrics()
+        self.stats = stats
+        self.heartbeat_at = 0
         self.reset()
+        if session is None:
+            session = http_pool.make_session_from_config(config.get('http'))
         soundcloud_config = config['soundcloud']
-        self.soundcloud = soundcloud.Client(client_id=soundcloud_config['client_id'])
+        self.soundcloud = http_pool.ApiClient(soundcloud_config['client_id'],
+                                              session,
+                                              soundcloud_config.get('api_url',
+                                                                    http_pool.API_URL),
+                                              page_cache)
         dbconfig = config['database']
         self.connection = mysql.connector.connect(user=dbconfig['user'],
                                                   password=dbconfig['password'],
                                                   host=dbconfig['host'],
                                                   database=dbconfig['database'],
-                                                  autocommit=True)
+                                                  autocommit=True,
+                                                  # Matched, not changed, rows
+                                                  client_flags=[ClientFlag.FOUND_ROWS])
         self.cursor = self.connection.cursor()
 
     def reset(self):
@@ -74,160 +276,539 @@ class Worker (object):
         self.date_range = None
         self.next_href = None
         self.time_slice_id = -1
+        self.date_from = None
+        self.date_to = None
+        self.pages = 0
+        self.track_count = 0
+        self.retry_count = 0
+        self.first_created_at = None
+        self.last_created_at = None
 
     def shutdown(self):
         self.cursor.close()
         self.connection.close()
 
-    def escape (self, field):
-        if field:
-            field = field.replace("\n", "\\n")
-            field = field.replace("\r", "\\r")
-            field = field.replace("\t", "\\t")
-        return field
-
-    def insertTrack(self, track):
-        self.cursor.execute(INSERT_TRACK,
-                            {'download_url': track.download_url,
-                             'license': track.license,
-                             'permalink_url': track.permalink_url,
-                             'title': self.escape(track.title),
-                             'description': self.escape(track.description),
-                             'created_at': track.created_at,
-                             'genre': self.escape(track.genre),
-                             'track_type': self.escape(track.track_type),
-                             'username': self.escape(track.user['username']),
-                             'label_name': self.escape(track.label_name)})
-
-    def insertTracks(self, tracks):
-        for track in tracks.collection:
-            self.insertTrack(track)
-        self.set_next_href(tracks)
-        self.updateState()
-
-    def updateState(self):
+    def insertTracks(self, page):
+        tracks = trackrows.page_tracks(page)
+        unseen = set(self.seen_tracks.unseen([track['id']
+                                              for track in tracks]))
+        rows = [trackrows.track_row(track) for track in tracks
+                if track['id'] in unseen]
+        previous_href = self.next_href
+        self.next_href = page.get('next_href')
+        # Insert the page and checkpoint next_href atomically, so a crash
+        # can't leave a half-inserted page behind a stale next_href
+        self.connection.start_transaction()
+        try:
+            with self.stats.timer('db_insert'):
+                if rows:
+                    self.cursor.executemany(INSERT_TRACK, rows)
+                    self.updateHighWater(rows)
+                self.updateState(len(tracks))
+                self.connection.commit()
+        except:
+            self.connection.rollback()
+            self.stats.count('db_errors')
+            # Refetch this page rather than skipping it
+            self.next_href = previous_href
+            raise
+        self.stats.count('pages')
+        self.stats.count('tracks', len(tracks))
+        self.stats.count('tracks_inserted', len(rows))
+        self.seen_tracks.add(unseen)
+        self.pages += 1
+        self.track_count += len(tracks)
+        if tracks:
+            if self.first_created_at is None:
+                self.first_created_at = tracks[0]['created_at']
+            self.last_created_at = tracks[-1]['created_at']
+
+    def updateHighWater(self, rows):
+        # The format sorts as the times do
+        newest = max(row[trackrows.CREATED_AT] for row in rows)
+        self.cursor.execute(UPDATE_HIGH_WATER,
+                            {'license': self.license,
+                             'created_at': parse_created_at(newest)})
+
+    def updateState(self, page_tracks=0):
         self.cursor.execute(UPDATE_NEXT_HREF,
                             {'time_slice_id': self.time_slice_id,
-                             'next_href': self.next_href})
-
-    def set_next_href (self, tracks):
-        try:
-            self.next_href = tracks.next_href
-        except Exception as e:
-            self.next_href = None
+                             'next_href': self.next_href,
+                             'page_tracks': page_tracks,
+                             'my_identifier': self.identifier,
+                             'lease_seconds': LEASE_SECONDS})
+        if self.cursor.rowcount == 0:
+            raise LeaseLost(self.time_slice_id)
+
+    def updateHeartbeat(self):
+        self.cursor.execute(UPDATE_HEARTBEAT,
+                            {'my_identifier': self.identifier,
+                             'lease_seconds': LEASE_SECONDS})
+        self.heartbeat_at = time.time()
+
+    def heartbeatIfDue(self):
+        if time.time() - self.heartbeat_at >= HEARTBEAT_SECONDS:
+            self.updateHeartbeat()
+
+    def fetch (self, path_or_url, **params):
+        """Get a page from the API, waiting out throttling and trying again."""
+        while True:
+            with self.stats.timer('rate_limit_wait'):
+                self.rate_limiter.acquire()
+            self.stats.count('api_requests')
+            try:
+                with self.stats.timer('api_request'):
+                    page = self.soundcloud.get_page(path_or_url, **params)
+            except ratecontrol.Throttled as e:
+                logging.log(LOGLEVEL, "%s on %s", e, self.time_slice_id)
+                self.stats.count('api_status_{0}'.format(e.status_code))
+                self.rate_limiter.throttled(e.retry_after)
+                self.stats.gauge('api_requests_per_second',
+                                 self.rate_limiter.rate)
+                # Waiting for the rate limiter mustn't cost us the lease
+                self.heartbeatIfDue()
+                continue
+            except requests.HTTPError as e:
+                self.stats.count('api_status_{0}'.format(
+                    e.response.status_code if e.response is not None
+                    else 'unknown'))
+                raise
+            except requests.RequestException:
+                self.stats.count('api_connection_errors')
+                raise
+            self.rate_limiter.succeeded()
+            self.stats.gauge('api_requests_per_second', self.rate_limiter.rate)
+            return page
 
     def initialFetch (self):
         try:
-            tracks = self.soundcloud.get('/tracks',
-                                         license=self.license,
-                                         created_at=self.date_range,
-                                         filter='public',
-                                         order='created_at',
-                                         limit=RESULTS_PER_PAGE,
-                                         linked_partitioning=1)
-            self.insertTracks(tracks)
-        # We get an error when there are no more results. Meh.
+            page = self.fetch('/tracks',
+                              license=self.license,
+                              created_at=self.date_range,
+                              filter='public',
+                              order='created_at',
+                              limit=RESULTS_PER_PAGE,
+                              linked_partitioning=1)
+            self.insertTracks(page)
         except requests.HTTPError as e:
-            logging.log(LOGLEVEL, e)
-            self.markTaskFinished()
-            return
-        except Exception as e:
-            logging.error(e)
-            exit(1)
+            self.finishIfNoMoreResults(e)
 
     def subsequentFetch (self):
         try:
-            tracks = self.soundcloud.get(self.next_href)
-            self.insertTracks(tracks)
-        # We get an error when there are no more results. Meh.
+            page = self.fetch(self.next_href)
+            self.insertTracks(page)
         except requests.HTTPError as e:
-            print(e)
-            self.markTaskFinished()
-            return
-        except Exception as e:
-            print(e)
+            self.finishIfNoMoreResults(e)
+
+    def finishIfNoMoreResults(self, error):
+        """We get a 400 past the last offset, or a 404, when there are no
+           more results. Meh. Anything else, e.g. a 502 from the gateway or a
+           401 for a bad client_id, is raised again so the shard is put aside
+           and retried rather than finished with tracks missing."""
+        if not http_pool.no_more_results(error):
+            raise error
+        logging.log(LOGLEVEL, error)
+        self.markTaskFinished()
 
     def markTaskFinished(self):
         self.next_href = None
-        self.updateState()
+        self.cursor.execute(UPDATE_TASK_FINISHED,
+                            {'time_slice_id': self.time_slice_id,
+                             'my_identifier': self.identifier})
 
     def taskInProgress(self):
         return self.next_href != None
 
-    def runTask(self, tries=0):
-        if not self.next_href:
-            self.initialFetch()
-        while self.taskInProgress():
-            try:
-                started_at = int(round(time.time() * 1000))
+    def crawledDescending(self):
+        """Whether the pages have come newest first, from the first and last
+           tracks seen, or None if we can't tell yet."""
+        if not (self.first_created_at and self.last_created_at) \
+           or self.first_created_at == self.last_created_at:
+            return None
+        return self.last_created_at < self.first_created_at
+
+    def splitRanges(self):
+        """The part of the shard's range we haven't reached yet, from the last
+           track we saw, cut into up to SPLIT_WAYS sub-ranges. Empty if it
+           isn't worth splitting."""
+        descending = self.crawledDescending()
+        if (self.pages < SPLIT_AFTER_PAGES) or (descending is None):
+            return []
+        split_at = parse_created_at(self.last_created_at)
+        if descending:
+            (rest_from, rest_to) = (self.date_from, split_at)
+        else:
+            (rest_from, rest_to) = (split_at, self.date_to)
+        if rest_from >= rest_to:
+            return []
+        seconds = int((rest_to - rest_from).total_seconds()) + 1
+        ways = min(SPLIT_WAYS, seconds // MIN_SPLIT_SECONDS)
+        if ways < 2:
+            return []
+        stride = datetime.timedelta(seconds=seconds // ways)
+        ranges = []
+        for way in range(ways):
+            range_from = rest_from + (stride * way)
+            range_to = range_from + stride - ONE_SECOND
+            ranges.append((range_from, range_to))
+        # Don't lose the remainder to rounding
+        ranges[-1] = (ranges[-1][0], rest_to)
+        return ranges
+
+    def splitTask(self, ranges):
+        """Finish this shard at the last track we saw and hand the rest of its
+           range, before or after that depending on which way the pages came,
+           out as new fresh shards. Tracks at exactly that time will be
+           fetched twice, the INSERT IGNORE takes care of them."""
+        descending = self.crawledDescending()
+        if descending:
+            split_at = ranges[-1][1]
+            update = UPDATE_SPLIT_TASK_FROM
+            (date_from, date_to) = (split_at, self.date_to)
+        else:
+            split_at = ranges[0][0]
+            update = UPDATE_SPLIT_TASK
+            (date_from, date_to) = (self.date_from, split_at)
+        self.connection.start_transaction()
+        try:
+            self.cursor.execute(update,
+                                {'time_slice_id': self.time_slice_id,
+                                 'my_identifier': self.identifier,
+                                 'date_from': date_from,
+                                 'date_to': date_to})
+            if self.cursor.rowcount == 0:
+                raise LeaseLost(self.time_slice_id)
+            self.cursor.executemany(INSERT_SPLIT_SHARD,
+                                    [{'date_from': range_from,
+                                      'date_to': range_to,
+                                      'license': self.license}
+                                     for (range_from, range_to) in ranges])
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        self.stats.count('shards_split')
+        logging.log(LOGLEVEL, "Split %s into %s shards %s %s",
+                    self.time_slice_id, len(ranges),
+                    'before' if descending else 'from', split_at)
+        self.next_href = None
+        self.date_from = date_from
+        self.date_to = date_to
+
+    def splitTaskIfDense(self):
+        ranges = self.splitRanges()
+        if ranges:
+            self.splitTask(ranges)
+
+    def mergeFollowingTasks(self):
+        """Fold the run of unclaimed shards following this sparse one into a
+           single shard up to twice this one's width."""
+        width = self.date_to - self.date_from + ONE_SECOND
+        merge_until = self.date_to + min(width * 2, MAX_MERGE_WIDTH)
+        self.connection.start_transaction()
+        try:
+            self.cursor.execute(SELECT_FOLLOWING_FRESH_TASKS,
+                                {'license': self.license,
+                                 'date_from': self.date_from,
+                                 'merge_until': merge_until})
+            following = self.cursor.fetchall()
+            # Only merge shards that are contiguous with this one
+            run = []
+            previous_to = self.date_to
+            for (time_slice_id, date_from, date_to) in following:
+                if date_from > previous_to + ONE_SECOND:
+                    break
+                run.append(time_slice_id)
+                previous_to = date_to
+            if len(run) > 1:
+                self.cursor.execute(UPDATE_MERGED_TASK,
+                                    {'time_slice_id': run[0],
+                                     'date_to': previous_to})
+                self.cursor.executemany(DELETE_MERGED_TASK,
+                                        [{'time_slice_id': time_slice_id}
+                                         for time_slice_id in run[1:]])
+            self.connection.commit()
+        except:
+            self.connection.rollback()
+            raise
+        if len(run) > 1:
+            self.stats.count('shards_merged', len(run) - 1)
+            logging.log(LOGLEVEL, "Merged %s shards following %s",
+                        len(run), self.time_slice_id)
+
+    def retryDelay(self):
+        """Exponential backoff on the number of failures, jittered so that
+           shards that failed together aren't all retried together."""
+        delay = min(MAX_RETRY_DELAY, RETRY_DELAY * (2 ** self.retry_count))
+        return int(delay * random.uniform(0.5, 1.5))
+
+    def deferTask(self):
+        delay = self.retryDelay()
+        self.cursor.execute(UPDATE_DEFER_TASK,
+                            {'time_slice_id': self.time_slice_id,
+                             'my_identifier': self.identifier,
+                             'delay': delay})
+        self.stats.count('shards_deferred')
+        logging.log(LOGLEVEL, "Retrying %s in %s seconds (failure %s)",
+                    self.time_slice_id, delay, self.retry_count + 1)
+        self.next_href = None
+
+    def runTask(self):
+        try:
+            if not self.next_href:
+                self.initialFetch()
+            while self.taskInProgress():
+                self.heartbeatIfDue()
+                self.splitTaskIfDense()
+                if not self.taskInProgress():
+                    break
+                # The rate limiter makes sure we don't call the API too
+                # often, and retries the page if we're throttled
                 self.subsequentFetch()
-                ended_at = int(round(time.time() * 1000))
-                # Make sure we don't call the API too often
-                execution_time = ended_at - started_at
-                if execution_time < API_HIT_TIME:
-                    time.sleep((API_HIT_TIME - execution_time) / 1000.0)
+            self.markTaskFinished()
+            self.stats.count('shards_finished')
+        except LeaseLost:
+            # Whoever has it now will carry on from its next_href
+            self.stats.count('leases_lost')
+            logging.log(LOGLEVEL, "Lost lease on %s", self.time_slice_id)
+            self.next_href = None
+            return
+        except Exception as e:
+            logging.error("Failed on %s - %s", self.time_slice_id, e)
+            try:
+                self.deferTask()
+            except Exception as defer_error:
+                # The lease will run out and someone will pick it up anyway
+                logging.error("Couldn't put aside %s - %s",
+                              self.time_slice_id, defer_error)
+            if isinstance(e, requests.HTTPError) \
+               and e.response is not None \
+               and e.response.status_code in CREDENTIAL_ERROR_STATUSES:
+                raise
+            return
+        if self.track_count < MERGE_BELOW_TRACKS:
+            try:
+                self.mergeFollowingTasks()
             except Exception as e:
-                logging.error(e)
-                time.sleep(SLEEP_TIME)
-                if tries < MAX_TRIES:
-                    logging.info("Retrying %s - %s", self.time_slice_id, e)
-                    self.runTask(tries + 1)
-                else:
-                    self.markTaskFinished()
-                    logging.error("Giving up on %s - %s", self.time_slice_id, e)
-        self.markTaskFinished()
+                logging.error("Couldn't merge after %s - %s",
+                              self.time_slice_id, e)
 
     def configureFromTask(self, task):
-        (time_slice_id, date_from, date_to, lic, worker, next_href) = task
+        (time_slice_id, date_from, date_to, lic, worker, next_href,
+         track_count, retry_count) = task
+        self.reset()
         self.time_slice_id = time_slice_id
         # The SQL datetime format is the same as used by Soundcloud
         self.date_range = {"from": date_from,
                            "to": date_to}
+        self.date_from = date_from
+        self.date_to = date_to
         self.license = lic
         self.next_href = next_href
-
-    def selectUnfinishedTask(self):
-        got_task = False
-        self.cursor.execute(SELECT_UNFINISHED_TASK,
-                            {'my_identifier': self.identifier})
-        result = self.cursor.fetchone()
-        if result is not None:
-            got_task = True
-            self.configureFromTask(result)
-        return got_task
-
-    def updateFreshTask(self):
-        got_task = False
-        self.cursor.execute(UPDATE_FRESH_TASK,
-                            {'my_identifier':self.identifier})
-        self.cursor.execute(SELECT_FRESH_TASK)
-        result = self.cursor.fetchone()
-        if result is not None:
-            got_task = True
-            self.configureFromTask(result)
-        return got_task
+        self.track_count = track_count
+        self.retry_count = retry_count
+
+    def claimTasks(self):
+        """Claim a batch of fresh or abandoned shards, and return all the shards
+           we currently hold a lease on (including any from before a restart)."""
+        with self.stats.timer('db_claim'):
+            self.cursor.execute(UPDATE_CLAIM_TASKS,
+                                {'my_identifier': self.identifier,
+                                 'lease_seconds': LEASE_SECONDS,
+                                 'quantity': CLAIM_BATCH_SIZE})
+            self.cursor.execute(SELECT_LEASED_TASKS,
+                                {'my_identifier': self.identifier})
+            tasks = self.cursor.fetchall()
+        self.heartbeat_at = time.time()
+        return tasks
 
     def logTask(self):
         logging.log(LOGLEVEL, "TIME_SLICE %s",
                     self.time_slice_id)
 
+    def unfinishedWait(self):
+        """Seconds until a shard that isn't finished can next be claimed, if
+           its lease isn't renewed, or None if they are all finished."""
+        self.cursor.execute(SELECT_UNFINISHED_WAIT)
+        (wait,) = self.cursor.fetchone()
+        return wait
+
     def go(self):
-        logging.log(LOGLEVEL, 'Starting unfinished tasks.')
-        while self.selectUnfinishedTask():
-            self.logTask()
-            self.runTask()
-        logging.log(LOGLEVEL, 'Finished unfinished tasks.')
-        logging.log(LOGLEVEL, 'Starting fresh tasks.')
-        while self.updateFreshTask():
-            self.logTask()
-            self.runTask()
-        logging.log(LOGLEVEL, 'Finished fresh tasks.')
+        logging.log(LOGLEVEL, 'Starting tasks.')
+        while True:
+            tasks = self.claimTasks()
+            if tasks:
+                for task in tasks:
+                    self.configureFromTask(task)
+                    self.logTask()
+                    self.runTask()
+                continue
+            # Stay to pick up shards that are put aside, split off, or left by
+            # a worker that dies, checking at least every HEARTBEAT_SECONDS
+            wait = self.unfinishedWait()
+            if wait is None:
+                break
+            logging.log(LOGLEVEL, 'Waiting %s seconds for unfinished shards.',
+                        wait)
+            with self.stats.timer('unfinished_wait'):
+                time.sleep(max(1, min(wait, HEARTBEAT_SECONDS)))
+            self.heartbeatIfDue()
+        logging.log(LOGLEVEL, 'Finished tasks.')
         logging.log(LOGLEVEL, 'Shutting down.')
         self.shutdown()
         logging.log(LOGLEVEL, 'Shut down.')
 
+class Crawler (object):
+
+    """Runs several Workers, one per thread, each with its own database
+       connection and worker identifier but all drawing on the same rate
+       limiter, so together they use the client_id's whole request budget."""
+
+    def __init__(self, config):
+        worker_config = config['worker']
+        concurrency = int(worker_config.get('concurrency', 1))
+        soundcloud_config = config['soundcloud']
+        rate = soundcloud_config.get('requests_per_second',
+                                     API_REQUESTS_PER_SECOND)
+        max_rate = soundcloud_config.get('max_requests_per_second',
+                                         max(rate, MAX_API_REQUESTS_PER_SECOND))
+        self.rate_limiter = ratecontrol.AdaptiveRateLimiter(rate, max_rate)
+        # Each thread claims its own shards, so needs its own identifier
+        if concurrency == 1:
+            identifiers = [worker_config['id']]
+        else:
+            identifiers = ["{0}.{1}".format(worker_config['id'], index)
+                           for index in range(concurrency)]
+        # One keep-alive pool, one memory of inserted tracks and one set of
+        # metrics for all the threads
+        self.session = http_pool.make_session_from_config(config.get('http'))
+        self.seen_tracks = SeenTracks(worker_config.get('seen_tracks',
+                                                        SEEN_TRACKS))
+        self.stats = metrics.Metrics()
+        self.stats.gauge('concurrency', concurrency)
+        self.metrics_path = worker_config.get('metrics_path', METRICS_PATH)
+        self.page_cache = None
+        if worker_config.get('page_cache'):
+            self.page_cache = pagecache.PageCache(worker_config['page_cache'])
+        self.workers = [Worker(config, self.rate_limiter, identifier,
+                               self.session, self.seen_tracks, self.stats,
+                               self.page_cache)
+                        for identifier in identifiers]
+
+    def runWorker(self, worker):
+        try:
+            worker.go()
+        except Exception as e:
+            # e.g. the database going away while claiming shards
+            logging.exception("Worker %s failed - %s", worker.identifier, e)
+            self.stats.count('workers_failed')
+            self.failed.append(worker.identifier)
+
+    def go(self):
+        """Crawl until there are no shards left, returning False if any of
+           the workers failed rather than running out of shards."""
+        self.failed = []
+        snapshots = metrics.SnapshotWriter(self.stats, self.metrics_path)
+        snapshots.start()
+        threads = [threading.Thread(target=self.runWorker, args=(worker,))
+                   for worker in self.workers]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Join with a timeout so we can still be interrupted
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            snapshots.stop()
+            if self.page_cache is not None:
+                self.page_cache.close()
+        return not self.failed
+
+class Replayer (object):
+
+    """Inserts the tracks from every page in the page cache, e.g. into a
+       table recreated after a schema change, without the API or the shards.
+       As when crawling, tracks already in the table are left as they are."""
+
+    def __init__(self, config, page_cache_directory):
+        self.page_cache = pagecache.PageCache(page_cache_directory)
+        self.seen_tracks = SeenTracks(config['worker'].get('seen_tracks',
+                                                           SEEN_TRACKS))
+        dbconfig = config['database']
+        self.connection = mysql.connector.connect(user=dbconfig['user'],
+                                                  password=dbconfig['password'],
+                                                  host=dbconfig['host'],
+                                                  database=dbconfig['database'])
+        self.cursor = self.connection.cursor()
+
+    def insertPage(self, page):
+        tracks = trackrows.page_tracks(page)
+        unseen = set(self.seen_tracks.unseen([track['id']
+                                              for track in tracks]))
+        rows = [trackrows.track_row(track) for track in tracks
+                if track['id'] in unseen]
+        if rows:
+            self.cursor.executemany(INSERT_TRACK, rows)
+        self.seen_tracks.add(unseen)
+        return len(rows)
+
+    def go(self):
+        logging.log(LOGLEVEL, 'Replaying %s.', self.page_cache.directory)
+        pages = 0
+        tracks = 0
+        for page in self.page_cache.pages():
+            tracks += self.insertPage(page)
+            pages += 1
+            if pages % REPLAY_COMMIT_PAGES == 0:
+                self.connection.commit()
+                logging.log(LOGLEVEL, 'Replayed %s pages, %s tracks.',
+                            pages, tracks)
+        self.connection.commit()
+        logging.log(LOGLEVEL, 'Replayed %s pages, %s tracks.', pages, tracks)
+        self.cursor.close()
+        self.connection.close()
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl Soundcloud tracks '
+                                     'into the database.')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--replay', action='store_true',
+                        help='insert the tracks from the page cache rather '
+                             'than crawling')
+    parser.add_argument('--page-cache',
+                        help='the page cache to replay, by default '
+                             'worker.page_cache')
+    # These override config.yaml, crawl-supervisor.py sets them for each
+    # process it runs
+    parser.add_argument('--worker-id', help='overrides worker.id')
+    parser.add_argument('--client-id', help='overrides soundcloud.client_id')
+    parser.add_argument('--rate', type=float,
+                        help='overrides soundcloud.requests_per_second')
+    parser.add_argument('--max-rate', type=float,
+                        help='overrides soundcloud.max_requests_per_second')
+    parser.add_argument('--metrics-path', help='overrides worker.metrics_path')
+    args = parser.parse_args()
     logging.basicConfig(level=LOGLEVEL)
-    config = yaml.load(open('config.yaml'))
-    worker = Worker(config)
-    worker.go()
+    config = yaml.load(open(args.config))
+    overrides = [('worker', 'id', args.worker_id),
+                 ('soundcloud', 'client_id', args.client_id),
+                 ('soundcloud', 'requests_per_second', args.rate),
+                 ('soundcloud', 'max_requests_per_second', args.max_rate),
+                 ('worker', 'metrics_path', args.metrics_path)]
+    for (section, key, value) in overrides:
+        if value is not None:
+            config[section][key] = value
+    if args.replay:
+        page_cache_directory = args.page_cache \
+            or config['worker'].get('page_cache')
+        if not page_cache_directory:
+            parser.error('No page cache to replay, set worker.page_cache '
+                         'or --page-cache')
+        Replayer(config, page_cache_directory).go()
+    else:
+        crawler = Crawler(config)
+        # Non-zero so that crawl-supervisor.py starts us again
+        if not crawler.go():
+            sys.exit(1)
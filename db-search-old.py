@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-import csv, datetime, sys, time
+import argparse, csv, datetime, time
 import requests
-import soundcloud
 
 import config
+import http_pool, pagecache, ratecontrol, trackrows
 
 licenses = [
     ##"no-rights-reserved",
@@ -19,6 +19,19 @@ licenses = [
 
 page_size = 100
 
+# Start at one request per second, and speed up while we aren't throttled
+requests_per_second = 1.0
+max_requests_per_second = 4.0
+
+# Seconds to wait before trying a page again after a server or connection
+# error, doubling each time up to max_retry_delay
+retry_delay = 10
+max_retry_delay = 60 * 60
+
+# Every page is saved here, so the TSVs can be written again with --replay.
+# Not date-worker.py's page cache, or replaying would write its pages too.
+page_cache_directory = 'db-search-old-pages'
+
 # https://blog.soundcloud.com/2008/10/17/cc/
 date_start = datetime.datetime(2016, 2, 6)
 date_today = datetime.date.today()
@@ -32,83 +45,138 @@ def created_at_range (date):
     return {"from": date.strftime("%Y-%m-%d %H:%M:%S"),
             "to": date_to.strftime("%Y-%m-%d %H:%M:%S")}
 
-def escape (field):
-    if field:
-        field = field.replace("\n", "\\n")
-        field = field.replace("\r", "\\r")
-        field = field.replace("\t", "\\t")
-    return field
-
-def print_track (writer, track):
-    writer.writerow((track.download_url,
-                     track.license,
-                     track.uri,
-                     escape(track.title),
-                     escape(track.description),
-                     track.created_at,
-                     escape(track.genre),
-                     escape(track.tag_list),
-                     escape(track.track_type),
-                     escape(track.user['username']),
-                     escape(track.label_name)))
-
-def print_tracks (writer, tracks):
-    for track in tracks.collection:
-        print_track(writer, track)
-
-def get_next_href (tracks):
-    try:
-        next_href = tracks.next_href
-    except Exception as e:
-        next_href = False
-    return next_href
+escape = trackrows.escape
+
+def track_row (track):
+    get = track.get
+    return (get('download_url'),
+            get('license'),
+            get('uri'),
+            escape(get('title')),
+            escape(get('description')),
+            get('created_at'),
+            escape(get('genre')),
+            escape(get('tag_list')),
+            escape(get('track_type')),
+            escape((get('user') or {}).get('username')),
+            escape(get('label_name')))
+
+def print_tracks (writer, page):
+    writer.writerows(track_row(track)
+                     for track in trackrows.page_tracks(page))
+
+def get_next_href (page):
+    return page.get('next_href') or False
+
+def is_server_error (error):
+    return isinstance(error, requests.HTTPError) \
+        and error.response is not None and error.response.status_code >= 500
+
+def fetch (client, rate_limiter, path_or_url, **params):
+    """Get a page, waiting out throttling, server and connection errors and
+       trying again."""
+    delay = retry_delay
+    while True:
+        rate_limiter.acquire()
+        try:
+            page = client.get_page(path_or_url, **params)
+        except ratecontrol.Throttled as e:
+            print(e)
+            rate_limiter.throttled(e.retry_after)
+            continue
+        except requests.RequestException as e:
+            if isinstance(e, requests.HTTPError) and not is_server_error(e):
+                raise
+            print("{0}, trying again in {1} seconds".format(e, delay))
+            time.sleep(delay)
+            delay = min(max_retry_delay, delay * 2)
+            continue
+        rate_limiter.succeeded()
+        return page
 
 #TODO: check for urlsfile and use last url if appropriate
 # use the offset from the last url if that's invalid
 # or just restart if not present/catastrophic failure
 # get first 100 tracks
 
-def initial_fetch (client, csvwriter, license_to_find):
+def initial_fetch (client, rate_limiter, csvwriter, license_to_find):
     try:
-        tracks = client.get('/tracks', license=license_to_find,
-                            created_at=created_at_range(date_start),
-                            filter='public', order='created_at',
-                            limit=page_size, linked_partitioning=1)
+        page = fetch(client, rate_limiter, '/tracks',
+                     license=license_to_find,
+                     created_at=created_at_range(date_start),
+                     filter='public', order='created_at',
+                     limit=page_size, linked_partitioning=1)
     except requests.HTTPError as e:
         print(e)
-        return False
+        if http_pool.no_more_results(e):
+            return False
+        raise
     except Exception as e:
         print(e)
         exit(1)
-    print_tracks(csvwriter, tracks)
-    return get_next_href(tracks)
+    print_tracks(csvwriter, page)
+    return get_next_href(page)
 
-def subsequent_fetches (client, csvwriter, urlsfile, next_href):
+def subsequent_fetches (client, rate_limiter, csvwriter, urlsfile, next_href):
     while next_href:
         print(".")
         print(next_href, file=urlsfile)
         # Make sure it's written immediately
         urlsfile.flush()
-        time.sleep(1)
         try:
-            tracks = client.get(next_href)
+            page = fetch(client, rate_limiter, next_href)
         except requests.HTTPError as e:
             print(e)
-            return
+            if http_pool.no_more_results(e):
+                return
+            raise
         except Exception as e:
             print(e)
-        print_tracks(csvwriter, tracks)
-        next_href = get_next_href(tracks)
+        print_tracks(csvwriter, page)
+        next_href = get_next_href(page)
 
-def fetch_all_licenses_sequentially (client, licenses):
+def fetch_all_licenses_sequentially (client, rate_limiter, licenses):
     for license_to_find in licenses:
         with open(license_to_find + '.tsv', mode='w',
                   encoding='utf-8') as outfile:
             csvwriter = csv.writer(outfile, delimiter="\t")
             urlsfile = open(license_to_find + '-urls.txt', 'w+')
-            next_href = initial_fetch(client, csvwriter, license_to_find)
-            subsequent_fetches (client, csvwriter, urlsfile, next_href)
+            next_href = initial_fetch(client, rate_limiter, csvwriter,
+                                      license_to_find)
+            subsequent_fetches (client, rate_limiter, csvwriter, urlsfile,
+                                next_href)
+
+def replay_all_licenses (page_cache, licenses):
+    """Write the TSVs from the cached pages rather than the API."""
+    outfiles = dict((license_to_find,
+                     open(license_to_find + '.tsv', mode='w', encoding='utf-8'))
+                    for license_to_find in licenses)
+    try:
+        csvwriters = dict((license_to_find, csv.writer(outfile, delimiter="\t"))
+                          for (license_to_find, outfile) in outfiles.items())
+        for page in page_cache.pages():
+            for track in trackrows.page_tracks(page):
+                if track.get('license') in csvwriters:
+                    csvwriters[track['license']].writerow(track_row(track))
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
 
 if __name__ == "__main__":
-    client = soundcloud.Client(client_id=config.client_id)
-    fetch_all_licenses_sequentially(client, licenses)
+    parser = argparse.ArgumentParser(description='Search for tracks by license.')
+    parser.add_argument('--replay', action='store_true',
+                        help='write the TSVs from the page cache')
+    args = parser.parse_args()
+    page_cache = pagecache.PageCache(page_cache_directory)
+    if args.replay:
+        replay_all_licenses(page_cache, licenses)
+    else:
+        client = http_pool.ApiClient(config.client_id,
+                                     http_pool.make_session(),
+                                     page_cache=page_cache)
+        rate_limiter = ratecontrol.AdaptiveRateLimiter(requests_per_second,
+                                                       max_requests_per_second)
+        try:
+            fetch_all_licenses_sequentially(client, rate_limiter, licenses)
+        finally:
+            page_cache.close()
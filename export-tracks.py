@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+# Exports soundcloud_tracks_by_date for analysis, as gzipped TSV or Parquet.
+# Rows are read a page at a time, keyset paginated on the id, so memory use
+# stays flat however big the table is. The id range is split into parts
+# exported in parallel by --jobs processes, each part to its own file:
+#
+#     python3 export-tracks.py --output-dir export --jobs 8
+#     python3 export-tracks.py --format parquet    # needs pyarrow
+#
+# Parts are named tracks-00000.tsv.gz and so on in id order, and gzipped
+# parts can be concatenated as they are. manifest.json lists the parts, their
+# row counts and the columns, which are in the order of COLUMNS. The TSV has
+# no header and is written as db-search-old.py writes its TSV.
+
+import argparse, csv, gzip, json, multiprocessing, os, time, yaml
+import mysql.connector
+
+COLUMNS = ['id', 'permalink_url', 'download_url', 'license', 'title',
+           'description', 'created_at', 'genre', 'track_type', 'username',
+           'label_name']
+
+# Rows fetched per query, and per Parquet row group
+PAGE_SIZE = 10000
+
+JOBS = 4
+
+# More parts than jobs, so a job that gets a dense range doesn't hold up the
+# rest
+PARTS_PER_JOB = 4
+
+# gzip (or Parquet's zstd) level, lower is faster
+COMPRESSION_LEVEL = 6
+
+# Parts are written under this suffix and renamed when complete
+PARTIAL_SUFFIX = '.part'
+
+SELECT_ID_RANGE = "SELECT MIN(id), MAX(id) FROM soundcloud_tracks_by_date"
+
+SELECT_PAGE = \
+"""SELECT {0} FROM soundcloud_tracks_by_date
+    WHERE id > %(after)s AND id <= %(last)s
+    ORDER BY id
+    LIMIT %(page_size)s""".format(', '.join(COLUMNS))
+
+def connect (dbconfig):
+    return mysql.connector.connect(user=dbconfig['user'],
+                                   password=dbconfig['password'],
+                                   host=dbconfig['host'],
+                                   database=dbconfig['database'])
+
+def id_ranges (first, last, parts):
+    """Split the ids from first to last into up to parts (after, last]
+       ranges."""
+    step = max(1, -(-(last - first + 1) // parts))
+    ranges = []
+    after = first - 1
+    while after < last:
+        ranges.append((after, min(after + step, last)))
+        after += step
+    return ranges
+
+def pages (cursor, after, last, page_size):
+    """The rows with ids in (after, last], page_size at a time."""
+    while True:
+        cursor.execute(SELECT_PAGE, {'after': after,
+                                     'last': last,
+                                     'page_size': page_size})
+        rows = cursor.fetchall()
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1][0]
+
+class TsvWriter (object):
+
+    extension = '.tsv.gz'
+
+    def __init__ (self, path, compression_level):
+        self.file = gzip.open(path, 'wt', encoding='utf-8', newline='',
+                              compresslevel=compression_level)
+        self.writer = csv.writer(self.file, delimiter="\t",
+                                 lineterminator="\n")
+
+    def write (self, rows):
+        self.writer.writerows(rows)
+
+    def close (self):
+        self.file.close()
+
+class ParquetWriter (object):
+
+    """Writes each page as a row group."""
+
+    extension = '.parquet'
+
+    def __init__ (self, path, compression_level):
+        import pyarrow, pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema(
+            [('id', pyarrow.uint32()),
+             ('created_at', pyarrow.timestamp('s'))]
+            + [(column, pyarrow.string()) for column in COLUMNS
+               if column not in ('id', 'created_at')])
+        self.writer = pyarrow.parquet.ParquetWriter(
+            path, self.schema, compression='zstd',
+            compression_level=compression_level)
+
+    def write (self, rows):
+        columns = dict(zip(COLUMNS, zip(*rows)))
+        arrays = [self.pyarrow.array(columns[field.name], type=field.type)
+                  for field in self.schema]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            arrays, schema=self.schema))
+
+    def close (self):
+        self.writer.close()
+
+FORMATS = {'tsv': TsvWriter,
+           'parquet': ParquetWriter}
+
+def export_part (job):
+    """Export one id range to its part file, returning its manifest entry."""
+    (dbconfig, options, index, (after, last)) = job
+    writer_class = FORMATS[options['format']]
+    path = os.path.join(options['output_dir'],
+                        'tracks-{0:05d}{1}'.format(index,
+                                                   writer_class.extension))
+    connection = connect(dbconfig)
+    cursor = connection.cursor()
+    rows = 0
+    writer = writer_class(path + PARTIAL_SUFFIX, options['compression_level'])
+    try:
+        for page in pages(cursor, after, last, options['page_size']):
+            writer.write(page)
+            rows += len(page)
+    finally:
+        writer.close()
+        cursor.close()
+        connection.close()
+    os.rename(path + PARTIAL_SUFFIX, path)
+    return {'path': os.path.basename(path),
+            'ids_after': after,
+            'ids_to': last,
+            'rows': rows}
+
+def export (dbconfig, options):
+    if options['format'] == 'parquet':
+        # Fail now rather than in every job
+        import pyarrow.parquet
+    if not os.path.isdir(options['output_dir']):
+        os.makedirs(options['output_dir'])
+    connection = connect(dbconfig)
+    cursor = connection.cursor()
+    cursor.execute(SELECT_ID_RANGE)
+    (first, last) = cursor.fetchone()
+    cursor.close()
+    connection.close()
+    started = time.time()
+    parts = []
+    if first is not None:
+        ranges = id_ranges(first, last, options['parts'])
+        jobs = [(dbconfig, options, index, id_range)
+                for (index, id_range) in enumerate(ranges)]
+        pool = multiprocessing.Pool(options['jobs'])
+        try:
+            for part in pool.imap_unordered(export_part, jobs):
+                print("{0}: {1} rows".format(part['path'], part['rows']))
+                parts.append(part)
+        finally:
+            pool.close()
+            pool.join()
+    parts.sort(key=lambda part: part['ids_after'])
+    rows = sum(part['rows'] for part in parts)
+    seconds = time.time() - started
+    manifest = {'format': options['format'],
+                'columns': COLUMNS,
+                'rows': rows,
+                'seconds': round(seconds, 1),
+                'parts': parts}
+    with open(os.path.join(options['output_dir'], 'manifest.json'),
+              'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    print("Exported {0} tracks in {1} parts in {2:.0f} seconds.".format(
+        rows, len(parts), seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the crawled tracks.')
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--output-dir', default='export')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='tsv')
+    parser.add_argument('--jobs', type=int, default=JOBS)
+    parser.add_argument('--parts', type=int,
+                        help='id ranges to split the export into, '
+                             'default {0} per job'.format(PARTS_PER_JOB))
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE)
+    parser.add_argument('--compression-level', type=int,
+                        default=COMPRESSION_LEVEL)
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config))
+    export(config['database'],
+           {'output_dir': args.output_dir,
+            'format': args.format,
+            'jobs': args.jobs,
+            'parts': args.parts or args.jobs * PARTS_PER_JOB,
+            'page_size': args.page_size,
+            'compression_level': args.compression_level})
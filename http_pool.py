@@ -0,0 +1,85 @@
+import json, requests
+from requests.adapters import HTTPAdapter
+
+import ratecontrol
+
+# Pooled keep-alive HTTP sessions, so that requests in the hot path reuse
+# connections rather than paying for a TCP and TLS handshake each time.
+# A session is safe to share between the threads in a process, size its pool
+# to the number of threads.
+
+API_URL = 'https://api.soundcloud.com'
+
+# Number of hosts to keep pools for
+POOL_CONNECTIONS = 4
+
+# Connections to keep open to each host
+POOL_MAXSIZE = 10
+
+def make_session (pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # The JSON API pages compress well
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    session.headers['Accept'] = 'application/json'
+    return session
+
+def make_session_from_config (http_config):
+    """Make a session from the (optional) http section of config.yaml."""
+    http_config = http_config or {}
+    return make_session(http_config.get('pool_connections', POOL_CONNECTIONS),
+                        http_config.get('pool_maxsize', POOL_MAXSIZE))
+
+# The API answers 400 for an offset past the last result, and 404 for a
+# next_href that has gone. Any other error, e.g. 401 for a bad client_id or
+# a 502 from the gateway, isn't the end of the results.
+NO_MORE_RESULTS_STATUSES = (400, 404)
+
+def no_more_results (error):
+    """Whether a requests.HTTPError just means there are no more results."""
+    return error.response is not None \
+        and error.response.status_code in NO_MORE_RESULTS_STATUSES
+
+def flatten_params (params):
+    """Soundcloud wants nested params like created_at[from]=..."""
+    flat = {}
+    for key, value in params.items():
+        if isinstance(value, dict):
+            for subkey, subvalue in value.items():
+                flat["{0}[{1}]".format(key, subkey)] = subvalue
+        else:
+            flat[key] = value
+    return flat
+
+class ApiClient (object):
+
+    """Does what we used soundcloud.Client.get for, over a pooled session.
+       Takes either an API path and its params, or a full url such as a
+       next_href, and returns the decoded JSON. Raises ratecontrol.Throttled
+       when asked to slow down, and requests.HTTPError for other errors, see
+       no_more_results. Pages are saved to page_cache, a pagecache.PageCache,
+       if given."""
+
+    def __init__ (self, client_id, session, api_url=API_URL, page_cache=None):
+        self.client_id = client_id
+        self.session = session
+        self.api_url = api_url
+        self.page_cache = page_cache
+
+    def url (self, path_or_url):
+        if path_or_url.startswith('http'):
+            return path_or_url
+        return self.api_url + path_or_url
+
+    def get_page (self, path_or_url, **params):
+        params = flatten_params(params)
+        params['client_id'] = self.client_id
+        response = self.session.get(self.url(path_or_url), params=params)
+        ratecontrol.check_throttled(response)
+        response.raise_for_status()
+        if self.page_cache is not None:
+            self.page_cache.add(response.url, response.text)
+        return json.loads(response.text)
@@ -0,0 +1,161 @@
+import json, os, tempfile, threading, time
+
+# Counters and latency histograms for the crawler, so we can see where the
+# time goes (the API, waiting for the rate limiter, the database) and tune
+# concurrency on each VM. They are kept in memory, which costs a lock and a
+# few additions per event, and written out as JSON every few seconds by a
+# SnapshotWriter, e.g. to watch with:
+#
+#     watch -n 10 cat metrics.json
+#
+# worker/worker.py has its own copy, as it is deployed as a single file.
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, float('inf')]
+
+# Percentiles estimated from the histograms in snapshots
+PERCENTILES = [50, 90, 99]
+
+# Seconds between snapshots
+SNAPSHOT_INTERVAL = 10
+
+class Histogram (object):
+
+    """Counts of observations falling in each bucket, plus their sum."""
+
+    def __init__ (self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe (self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def percentile (self, percent):
+        """The upper bound of the bucket the percentile falls in."""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot (self):
+        snapshot = {'count': self.count,
+                    'sum': round(self.sum, 6),
+                    'buckets': dict((str(bound), count)
+                                    for bound, count in zip(self.buckets,
+                                                            self.counts))}
+        if self.count:
+            snapshot['mean'] = round(self.sum / self.count, 6)
+            for percent in PERCENTILES:
+                snapshot['p{0}'.format(percent)] = self.percentile(percent)
+        return snapshot
+
+class Timer (object):
+
+    """Observes how long its with block takes."""
+
+    def __init__ (self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__ (self):
+        self.started = time.time()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.started)
+        return False
+
+class Metrics (object):
+
+    """Thread-safe named counters, gauges and latency histograms."""
+
+    def __init__ (self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started_at = time.time()
+
+    def count (self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge (self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe (self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer (self, name):
+        return Timer(self, name)
+
+    def snapshot (self):
+        with self.lock:
+            now = time.time()
+            return {'time': now,
+                    'uptime': round(now - self.started_at, 3),
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'latency': dict((name, histogram.snapshot())
+                                    for name, histogram
+                                    in self.histograms.items())}
+
+    def writeSnapshot (self, path):
+        """Write the snapshot to path, atomically so readers never see half
+           of one."""
+        directory = os.path.dirname(os.path.abspath(path))
+        handle, temporary_path = tempfile.mkstemp(dir=directory,
+                                                  prefix='.metrics-')
+        with os.fdopen(handle, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file, indent=2, sort_keys=True)
+        os.rename(temporary_path, path)
+
+class SnapshotWriter (object):
+
+    """A thread that writes the metrics to path every interval seconds, and
+       once more when stopped."""
+
+    def __init__ (self, metrics, path, interval=SNAPSHOT_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start (self):
+        self.thread.start()
+        return self
+
+    def stop (self):
+        self.stopping.set()
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+    def write (self):
+        try:
+            self.metrics.writeSnapshot(self.path)
+        except (IOError, OSError) as e:
+            # Metrics aren't worth stopping the crawl for
+            print("Couldn't write metrics to {0}: {1}".format(self.path, e))
+
+    def run (self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+        self.write()
@@ -0,0 +1,116 @@
+import gzip, json, logging, os, threading, time, zlib
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlparse
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlparse
+
+# An append-only, compressed cache of the API's raw responses, so that a
+# schema change or a bug in how we store tracks can be fixed by replaying the
+# pages we already have, at disk speed, rather than crawling them again.
+#
+# Each process appends to its own file in the cache directory. A file is a
+# series of gzip members, one per page, each holding one line of JSON:
+#
+#     {"key": ..., "fetched_at": ..., "body": <the response text>}
+#
+# so a crash loses at most the page being written, and the files can be read
+# with zcat. The key is the request without the client_id, i.e. the license,
+# created_at range and cursor (offset) of the page.
+
+# Start a new file after this many (compressed) bytes
+MAX_FILE_BYTES = 256 * 1024 * 1024
+
+COMPRESSION_LEVEL = 6
+
+FILE_SUFFIX = '.jsonl.gz'
+
+def request_key (url):
+    """The url with its query in a canonical order, and without the
+       client_id, which has nothing to do with what the page holds."""
+    parsed = urlparse(url)
+    query = sorted((key, value) for (key, value) in parse_qsl(parsed.query)
+                   if key != 'client_id')
+    return "{0}?{1}".format(parsed.path, urlencode(query))
+
+class PageCache (object):
+
+    """Appends pages to the current file in directory, and reads them all
+       back. Safe to share between threads."""
+
+    def __init__ (self, directory, max_file_bytes=MAX_FILE_BYTES):
+        self.directory = directory
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        self.file = None
+        self.files_opened = 0
+
+    def open (self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = "pages-{0}-{1}-{2:04d}{3}".format(
+            time.strftime('%Y%m%d%H%M%S'), os.getpid(), self.files_opened,
+            FILE_SUFFIX)
+        self.files_opened += 1
+        self.file = open(os.path.join(self.directory, filename), 'ab')
+
+    def add (self, url, body):
+        record = json.dumps({'key': request_key(url),
+                             'fetched_at': time.time(),
+                             'body': body}) + "\n"
+        # Its own gzip member, so each page is complete on disk once written
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        member = compressor.compress(record.encode('utf-8')) \
+            + compressor.flush()
+        with self.lock:
+            if self.file is None or self.file.tell() >= self.max_file_bytes:
+                self.close()
+                self.open()
+            self.file.write(member)
+            self.file.flush()
+
+    def close (self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def paths (self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(os.path.join(self.directory, filename)
+                      for filename in os.listdir(self.directory)
+                      if filename.endswith(FILE_SUFFIX))
+
+    def records (self):
+        """Every cached page, oldest file first, as dicts with the key,
+           fetched_at and body."""
+        for path in self.paths():
+            cache_file = gzip.open(path, 'rb')
+            try:
+                for line in cache_file:
+                    yield json.loads(line.decode('utf-8'))
+            # Python 2's gzip raises TypeError for a truncated header
+            except (EOFError, IOError, TypeError, ValueError, zlib.error) as e:
+                # The last page of a file that was being written in a crash
+                logging.warning("Stopped reading %s at a damaged page: %s",
+                                path, e)
+            finally:
+                cache_file.close()
+
+    def pages (self):
+        """The decoded JSON of every cached page, once each: a page that was
+           fetched more than once, e.g. retried after a failure, is only
+           given as it was fetched last. Reads the cache twice, the first
+           time for just the keys."""
+        # Older files have whole seconds, so of pages fetched in the same
+        # second take the one read last, i.e. written last
+        newest = {}
+        for (position, record) in enumerate(self.records()):
+            fetched = (record['fetched_at'], position)
+            if fetched >= newest.get(record['key'], fetched):
+                newest[record['key']] = fetched
+        for (position, record) in enumerate(self.records()):
+            if newest.get(record['key']) == (record['fetched_at'], position):
+                yield json.loads(record['body'])
@@ -0,0 +1,125 @@
+import email.utils, threading, time
+
+# Rate limiting for the Soundcloud API, shared by the threads in a process.
+# A fixed rate is either slower than the API allows or fast enough to be
+# throttled, and a throttled page used to look just like the end of the
+# results. So the API client raises Throttled for a 429 or 503, and the
+# AdaptiveRateLimiter does AIMD: it speeds up a little for every request that
+# gets through, halves its rate when throttled, and waits out any Retry-After.
+
+# HTTP statuses that mean slow down rather than no more results
+THROTTLE_STATUSES = (429, 503)
+
+# Requests per second added for each second's worth of unthrottled requests
+RATE_INCREASE = 0.05
+
+# Multiply the rate by this when throttled
+RATE_DECREASE = 0.5
+
+# Never go slower than this many requests per second
+MIN_RATE = 0.1
+
+# Don't wait longer than this for a Retry-After, so leases can be renewed
+MAX_RETRY_AFTER = 5 * 60
+
+class Throttled (Exception):
+
+    """The API asked us to slow down. retry_after is the number of seconds it
+       asked us to wait, or None if it didn't say."""
+
+    def __init__ (self, status_code, retry_after=None):
+        super(Throttled, self).__init__(status_code, retry_after)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def __str__ (self):
+        return "Throttled ({0}), retry after {1}".format(self.status_code,
+                                                         self.retry_after)
+
+def parse_retry_after (value):
+    """Seconds to wait from a Retry-After header, either a number of seconds
+       or an HTTP date. None if it's missing or unreadable."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+def check_throttled (response):
+    """Raise Throttled if the response is the API asking us to slow down."""
+    if response.status_code in THROTTLE_STATUSES:
+        raise Throttled(response.status_code,
+                        parse_retry_after(response.headers.get('Retry-After')))
+
+class TokenBucket (object):
+
+    """A thread-safe token bucket. Every API request takes a token, tokens are
+       refilled at rate per second, up to capacity."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        elapsed = max(0, now - self.updated_at)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class AdaptiveRateLimiter (TokenBucket):
+
+    """A token bucket whose rate probes upwards towards max_rate while
+       requests succeed, and backs off when the API throttles us. Call
+       succeeded() or throttled() after each request."""
+
+    def __init__(self, rate, max_rate=None, min_rate=MIN_RATE,
+                 increase=RATE_INCREASE, decrease=RATE_DECREASE,
+                 max_retry_after=MAX_RETRY_AFTER):
+        super(AdaptiveRateLimiter, self).__init__(rate)
+        if max_rate is None:
+            max_rate = rate
+        self.max_rate = float(max_rate)
+        self.min_rate = min(float(min_rate), self.rate)
+        self.increase = float(increase)
+        self.decrease = float(decrease)
+        self.max_retry_after = max_retry_after
+        self.decreased_at = 0
+
+    def succeeded(self):
+        with self.lock:
+            self.refill()
+            # Spread the increase over a second's worth of requests
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.refill()
+            now = time.time()
+            # The other threads' requests in flight will be throttled too,
+            # only back off once for them
+            if now - self.decreased_at >= 1 / self.rate:
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.decreased_at = now
+            if retry_after is None:
+                retry_after = 1 / self.rate
+            retry_after = min(retry_after, self.max_retry_after)
+            # Go into debt so nobody gets a token until it has passed
+            self.tokens = min(self.tokens, 1 - (retry_after * self.rate))
@@ -0,0 +1,41 @@
+# Pages of tracks from the API, as decoded JSON, straight into row tuples for
+# the database or a TSV. This is the hot path when many shards are crawled in
+# one process, so there is no Resource object per track and no dict per row,
+# just one tuple of the columns we keep.
+
+# The columns of soundcloud_tracks_by_date, in the order of the row tuples
+COLUMNS = ('id', 'permalink_url', 'download_url', 'license', 'title',
+           'description', 'created_at', 'genre', 'track_type', 'username',
+           'label_name')
+
+# Positions of the columns we look at again once a row is made
+ID = COLUMNS.index('id')
+CREATED_AT = COLUMNS.index('created_at')
+
+def escape (field):
+    # Three replaces, each a fast scan that copies nothing if the character
+    # isn't there, which is most fields. Faster than one pass of translate.
+    if field:
+        field = field.replace("\n", "\\n")
+        field = field.replace("\r", "\\r")
+        field = field.replace("\t", "\\t")
+    return field
+
+def page_tracks (page):
+    """The tracks in a decoded page, as dicts."""
+    return page.get('collection') or []
+
+def track_row (track):
+    """A track's columns, in the order of COLUMNS."""
+    get = track.get
+    return (track['id'],
+            get('permalink_url'),
+            get('download_url'),
+            get('license'),
+            escape(get('title')),
+            escape(get('description')),
+            get('created_at'),
+            escape(get('genre')),
+            escape(get('track_type')),
+            escape((get('user') or {}).get('username')),
+            escape(get('label_name')))
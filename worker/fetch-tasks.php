@@ -24,6 +24,23 @@ global $dbh;
 
 $dbh = new PDO($DBDSN, $DBUSER, $DBPASSWORD);
 
+// Track ids are Soundcloud's, so they are sparse: take the next
+// $IDS_QUANTITY downloadable ids from the offset rather than a range of ids.
+// The same lock as task-feed.py, so two requests never get the same ids.
+
+$lock_statement = $dbh->prepare("SELECT GET_LOCK('download_ids_offsets', 10)");
+$ok = $lock_statement->execute();
+if ($ok === false || $lock_statement->fetchColumn() != 1) {
+    error_log("Couldn't lock the offsets for " . $requestor);
+    http_response_code(503);
+    exit;
+}
+
+function release_lock () {
+    global $dbh;
+    $dbh->query("SELECT RELEASE_LOCK('download_ids_offsets')");
+}
+
 // Where did the last downloader finish?
 
 $offset_statement = $dbh->prepare("SELECT ids_offset FROM download_ids_offsets
@@ -32,30 +49,34 @@ $offset_statement = $dbh->prepare("SELECT ids_offset FROM download_ids_offsets
 $ok = $offset_statement->execute();
 if ($ok === false) {
     error_log("Couldn't execute select on count to continue for " . $requestor);
+    release_lock();
     http_response_code(500);
     exit;
 }
 $start_offset = $offset_statement->fetchColumn();
 if ($start_offset === false) {
     error_log("Couldn't get count to continue column for " . $requestor);
+    release_lock();
     http_response_code(500);
     exit;
 }
 
-// exclusive range
-
-$end_offset = $start_offset + $IDS_QUANTITY;
-
 // Get the ids and urls from the database
 
-$tracks_info = false;
 $select_urls_statement = $dbh->prepare("SELECT id, download_url
                                        FROM soundcloud_tracks_by_date
-                                       WHERE id >= " . $start_offset
-                                    . " AND id  < " . $end_offset);
+                                       WHERE id >= :start
+                                         AND download_url != ''
+                                       ORDER BY id
+                                       LIMIT :quantity");
+$select_urls_statement->bindValue(':start', (int)$start_offset,
+                                  PDO::PARAM_INT);
+$select_urls_statement->bindValue(':quantity', (int)$IDS_QUANTITY,
+                                  PDO::PARAM_INT);
 $ok = $select_urls_statement->execute();
 if ($ok === false) {
     error_log("Couldn't select tacks for " . $requestor);
+    release_lock();
     http_response_code(500);
     exit;
 }
@@ -65,10 +86,30 @@ if ($ok === false) {
 $tracks = $select_urls_statement->fetchAll(PDO::FETCH_ASSOC);
 if ($tracks === false) {
     error_log("Couldn't fetch all tracks for " . $requestor);
+    release_lock();
     http_response_code(500);
     exit;
 }
 
+// Store the offset that the next task should start from, just past the
+// last id we hand out
+
+if (count($tracks) > 0) {
+    $end_offset = $tracks[count($tracks) - 1]['id'] + 1;
+    $store_offset_statement = $dbh->prepare("INSERT INTO download_ids_offsets
+                                                 (ids_offset)
+                                                 VALUES (:offset)");
+    $ok = $store_offset_statement->execute([':offset' => $end_offset]);
+    if ($ok === false) {
+        error_log("Couldn't save next offset (" . $end_offset . ") for "
+                . $requestor);
+        release_lock();
+        http_response_code(500);
+        exit;
+    }
+}
+release_lock();
+
 // Format as json, adding useful info
 
 if (count($tracks) > 0) {
@@ -79,20 +120,7 @@ if (count($tracks) > 0) {
         ]
     ]);
 } else {
-    error_log("Couldn't fetch all tracks for " . $requestor);
+    // There really are no more downloadable tracks
     http_response_code(404);
     echo json_encode([]);
 }
-
-// Store the offset that the next task should start from
-
-$store_offset_statement = $dbh->prepare("INSERT INTO download_ids_offsets
-                                             (ids_offset)
-                                             VALUES (:offset)");
-$ok = $store_offset_statement->execute([':offset' => $end_offset]);
-if ($ok === false) {
-    error_log("Couldn't save next offset (" . $end_offset . ") for "
-            . $requestor);
-    http_response_code(500);
-    exit;
-}
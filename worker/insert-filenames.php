@@ -0,0 +1,69 @@
+<?php
+
+/*
+
+   Batch version of insert-filename.php, for the same table.
+
+   POST pass and filenames, a JSON array of {"track_id": ..., "filename": ...}
+   objects. Responds 200 once they are all stored, so the worker can drop them
+   from its journal. Reports that are sent twice are ignored.
+
+*/
+
+require(__DIR__ . '/config.php');
+
+$requestor = $_SERVER['REMOTE_ADDR'];
+
+// Security figleaf.
+
+if (! isset($_REQUEST['pass'])) {
+    http_response_code(403);
+    exit('Bad pass.');
+}
+$passkey = $_REQUEST['pass'];
+if ($passkey != $FILENAME_INSERT_PASSKEY) {
+    http_response_code(400);
+    exit('Bad pass.');
+}
+
+// Get the params.
+
+if (! isset($_REQUEST['filenames'])) {
+    http_response_code(403);
+    exit('No filenames.');
+}
+$filenames = json_decode($_REQUEST['filenames'], true);
+if (! is_array($filenames)) {
+    http_response_code(400);
+    exit('Bad filenames.');
+}
+
+// Insert them all or none, so the worker knows whether to resend
+
+global $dbh;
+
+$dbh = new PDO($DBDSN, $DBUSER, $DBPASSWORD);
+
+$insert_statement = $dbh->prepare("INSERT IGNORE INTO track_original_filenames
+                                       (track_id, filename)
+                                       VALUES (:track_id, :filename)");
+$dbh->beginTransaction();
+foreach ($filenames as $report) {
+    if (! (isset($report['track_id']) && isset($report['filename']))) {
+        $dbh->rollBack();
+        http_response_code(400);
+        exit('Bad filename report.');
+    }
+    $ok = $insert_statement->execute([':track_id' => intval($report['track_id']),
+                                      ':filename' => $report['filename']]);
+    if ($ok === false) {
+        $dbh->rollBack();
+        error_log('Couldn\'t save filename "' . $report['filename'] . '" for '
+                . $report['track_id'] . ' from ' . $requestor);
+        http_response_code(500);
+        exit;
+    }
+}
+$dbh->commit();
+
+echo json_encode(['inserted' => count($filenames)]);
@@ -0,0 +1,93 @@
+<?php
+
+/*
+
+   CREATE TABLE content_hashes (
+       content_hash  CHAR(40)         NOT NULL PRIMARY KEY,
+       -- The first track we saw with this content, the one on the file server
+       track_id      INT              UNSIGNED NOT NULL
+   );
+   CREATE TABLE track_content_hashes (
+       track_id      INT              UNSIGNED NOT NULL PRIMARY KEY,
+       content_hash  CHAR(40)         NOT NULL
+   );
+
+   POST pass and hashes, a JSON array of {"track_id": ..., "content_hash": ...}
+   objects. Records each track's hash, and responds with a JSON object mapping
+   each track_id to the id of the track whose file has that content. Where
+   that's a different track, the worker doesn't upload the file, and the file
+   server finds it through track_content_hashes.
+
+*/
+
+require(__DIR__ . '/config.php');
+
+$requestor = $_SERVER['REMOTE_ADDR'];
+
+// Security figleaf.
+
+if (! isset($_REQUEST['pass'])) {
+    http_response_code(403);
+    exit('Bad pass.');
+}
+$passkey = $_REQUEST['pass'];
+if ($passkey != $FILENAME_INSERT_PASSKEY) {
+    http_response_code(400);
+    exit('Bad pass.');
+}
+
+// Get the params.
+
+if (! isset($_REQUEST['hashes'])) {
+    http_response_code(403);
+    exit('No hashes.');
+}
+$hashes = json_decode($_REQUEST['hashes'], true);
+if (! is_array($hashes)) {
+    http_response_code(400);
+    exit('Bad hashes.');
+}
+
+// Insert, the first track to claim a hash owns it
+
+global $dbh;
+
+$dbh = new PDO($DBDSN, $DBUSER, $DBPASSWORD);
+
+$insert_hash_statement = $dbh->prepare("INSERT IGNORE INTO content_hashes
+                                            (content_hash, track_id)
+                                            VALUES (:content_hash, :track_id)");
+$select_owner_statement = $dbh->prepare("SELECT track_id FROM content_hashes
+                                             WHERE content_hash = :content_hash");
+$insert_track_statement = $dbh->prepare("INSERT IGNORE INTO track_content_hashes
+                                             (track_id, content_hash)
+                                             VALUES (:track_id, :content_hash)");
+
+$canonical_ids = [];
+$dbh->beginTransaction();
+foreach ($hashes as $report) {
+    if (! (isset($report['track_id']) && isset($report['content_hash']))) {
+        $dbh->rollBack();
+        http_response_code(400);
+        exit('Bad hash report.');
+    }
+    $params = [':track_id' => intval($report['track_id']),
+               ':content_hash' => $report['content_hash']];
+    $ok = $insert_hash_statement->execute($params)
+       && $insert_track_statement->execute($params)
+       && $select_owner_statement->execute([':content_hash'
+                                            => $report['content_hash']]);
+    if ($ok === false) {
+        $dbh->rollBack();
+        error_log('Couldn\'t save hash for ' . $report['track_id'] . ' from '
+                . $requestor);
+        http_response_code(500);
+        exit;
+    }
+    $canonical_ids[strval(intval($report['track_id']))] =
+        intval($select_owner_statement->fetchColumn());
+    $select_owner_statement->closeCursor();
+}
+$dbh->commit();
+
+echo json_encode($canonical_ids);
@@ -0,0 +1,53 @@
+# Moves an existing tree of tracks from one storage layout to another, e.g.
+# on the file server after changing storage_layout in config.yaml:
+#
+#     python migrate-layout.py /scdl/tracks digits hashed
+#
+# Files are renamed, not copied, so the tree must be on one filesystem. It is
+# safe to interrupt and run again. Pack files are left where they are.
+
+import os, sys
+
+from worker import ensureDirectory, makeLayout, PARTIAL_SUFFIX
+
+def trackIdFromFilename (filename):
+    """The track id, or None for anything that isn't a track."""
+    (track_id, extension) = os.path.splitext(filename)
+    if extension == PARTIAL_SUFFIX or not track_id.isdigit():
+        return None
+    return str(int(track_id))
+
+def migrate (root, from_layout, to_layout):
+    moved = 0
+    for (directory, subdirectories, filenames) in os.walk(root):
+        # Don't descend into packs
+        if 'packs' in subdirectories:
+            subdirectories.remove('packs')
+        for filename in filenames:
+            track_id = trackIdFromFilename(filename)
+            if track_id is None:
+                continue
+            relative_directory = os.path.relpath(directory, root)
+            # Only move files that are where the old layout puts them
+            if relative_directory != from_layout.directory(track_id):
+                continue
+            new_directory = os.path.join(root, to_layout.directory(track_id))
+            ensureDirectory(new_directory)
+            os.rename(os.path.join(directory, filename),
+                      os.path.join(new_directory, filename))
+            moved += 1
+    return moved
+
+def removeEmptyDirectories (root):
+    for (directory, subdirectories, filenames) in os.walk(root, topdown=False):
+        if directory != root and not os.listdir(directory):
+            os.rmdir(directory)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print "Usage: python migrate-layout.py ROOT FROM_LAYOUT TO_LAYOUT"
+        sys.exit(1)
+    (root, from_name, to_name) = sys.argv[1:]
+    moved = migrate(root, makeLayout(from_name), makeLayout(to_name))
+    removeEmptyDirectories(root)
+    print "Moved {0} tracks.".format(moved)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+# A replacement for fetch-tasks.php that hands out tasks in larger batches,
+# and never hands out the same id twice, even to workers asking at once.
+#
+# GET /tasks?quantity=N leases the next N downloadable ids (those with a
+# download_url) after the last lease, and returns them in the same format as
+# fetch-tasks.php:
+#
+#     {"urls": [{"id": ..., "download_url": ...}, ...],
+#      "config": {"client_id": ...}}
+#
+# or a 404 and [] when there are none left. Leasing takes a MySQL named lock,
+# so several copies of this can run against the same database.
+#
+# Run it locally with:
+#
+#     python3 task-feed.py --config task-feed.yaml --port 8080
+
+import argparse, json, urllib.parse, yaml
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import mysql.connector
+
+# Ids per lease if the worker doesn't ask for a number, and the most it can
+IDS_QUANTITY = 100
+MAX_IDS_QUANTITY = 1000
+
+# Seconds to wait for another feed to finish leasing
+LOCK_TIMEOUT = 10
+
+GET_LEASE_LOCK = "SELECT GET_LOCK('download_ids_offsets', %(timeout)s)"
+
+RELEASE_LEASE_LOCK = "SELECT RELEASE_LOCK('download_ids_offsets')"
+
+SELECT_OFFSET = \
+"""SELECT ids_offset FROM download_ids_offsets
+    ORDER BY id DESC
+    LIMIT 1"""
+
+SELECT_DOWNLOADABLE_IDS = \
+"""SELECT id, download_url FROM soundcloud_tracks_by_date
+    WHERE id >= %(start)s AND download_url != ''
+    ORDER BY id
+    LIMIT %(quantity)s"""
+
+INSERT_OFFSET = \
+"""INSERT INTO download_ids_offsets (ids_offset) VALUES (%(offset)s)"""
+
+class LeaseUnavailable (Exception):
+
+    """We couldn't get the lock on the offsets."""
+
+    pass
+
+class TaskFeed (object):
+
+    """Leases ranges of downloadable track ids from the database."""
+
+    def __init__ (self, config):
+        self.client_id = config['client_id']
+        self.default_quantity = config.get('ids_quantity', IDS_QUANTITY)
+        self.max_quantity = config.get('max_ids_quantity', MAX_IDS_QUANTITY)
+        dbconfig = config['database']
+        self.connection = mysql.connector.connect(user=dbconfig['user'],
+                                                  password=dbconfig['password'],
+                                                  host=dbconfig['host'],
+                                                  database=dbconfig['database'],
+                                                  autocommit=True)
+
+    def quantity (self, requested):
+        if requested is None:
+            return self.default_quantity
+        return max(1, min(int(requested), self.max_quantity))
+
+    def lease (self, quantity):
+        """The next quantity downloadable ids, moving the offset past them."""
+        self.connection.ping(reconnect=True)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(GET_LEASE_LOCK, {'timeout': LOCK_TIMEOUT})
+            (locked,) = cursor.fetchone()
+            if locked != 1:
+                raise LeaseUnavailable()
+            try:
+                cursor.execute(SELECT_OFFSET)
+                (start_offset,) = cursor.fetchone()
+                cursor.execute(SELECT_DOWNLOADABLE_IDS,
+                               {'start': start_offset, 'quantity': quantity})
+                tracks = [{'id': track_id, 'download_url': download_url}
+                          for (track_id, download_url) in cursor.fetchall()]
+                if tracks:
+                    cursor.execute(INSERT_OFFSET,
+                                   {'offset': tracks[-1]['id'] + 1})
+            finally:
+                cursor.execute(RELEASE_LEASE_LOCK)
+                cursor.fetchall()
+        finally:
+            cursor.close()
+        return tracks
+
+    def tasks (self, requested_quantity=None):
+        tracks = self.lease(self.quantity(requested_quantity))
+        if not tracks:
+            return None
+        return {'urls': tracks,
+                'config': {'client_id': self.client_id}}
+
+class TaskFeedHandler (BaseHTTPRequestHandler):
+
+    def respond (self, code, body):
+        encoded = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def do_GET (self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        requested = query.get('quantity', [None])[0]
+        try:
+            tasks = self.server.feed.tasks(requested)
+        except ValueError:
+            self.respond(400, [])
+            return
+        except (LeaseUnavailable, mysql.connector.Error) as e:
+            self.log_error("Couldn't lease tasks for %s: %s",
+                           self.client_address[0], e)
+            self.respond(503, [])
+            return
+        if tasks is None:
+            self.respond(404, [])
+        else:
+            self.respond(200, tasks)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve download tasks.')
+    parser.add_argument('--config', default='task-feed.yaml')
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config))
+    # One request at a time is plenty, each lease is a few quick queries
+    server = HTTPServer((args.host, args.port), TaskFeedHandler)
+    server.feed = TaskFeed(config)
+    server.serve_forever()
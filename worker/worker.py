@@ -1,162 +1,1202 @@
-import errno, json, os.path, re, requests, shutil, signal, subprocess, yaml
+import contextlib, errno, hashlib, json, os.path, Queue, re, requests, shutil
+import signal, socket, sqlite3, subprocess, tempfile, threading, time, urlparse, yaml
+from requests.adapters import HTTPAdapter
 
 ################################################################################
 # Config
 ################################################################################
 
 TASKS_REQUEST_URL_PATH = 'fetch-tasks.php'
-INSERT_FILENAME_URL_PATH = 'insert-filename.php'
+INSERT_FILENAMES_URL_PATH = 'insert-filenames.php'
+INSERT_HASHES_URL_PATH = 'insert-hashes.php'
 
 SSH_ARGS = "ssh -i {0} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null"
 
+# Override with rsync_path, rsync_remote_path can also be a local directory
+RSYNC_PATH = '/usr/bin/rsync'
+
 # 32kb chunks
 CHUNK_SIZE = 1024 * 32
 
+# Downloads in progress are written here and renamed when complete
+PARTIAL_SUFFIX = '.part'
+
+# Seconds to wait before asking for tasks again after the feed fails,
+# doubling each time up to MAX_TASKS_RETRY_DELAY
+TASKS_RETRY_DELAY = 5
+MAX_TASKS_RETRY_DELAY = 5 * 60
+
+# Attempts at each download, each resuming where the last one stopped
+DOWNLOAD_TRIES = 3
+
+# Finished downloads are rsynced this many at a time
+UPLOAD_BATCH_SIZE = 20
+# Seconds to wait for a batch to fill before shipping what we have
+UPLOAD_WAIT = 5
+# Finished downloads allowed to wait for upload before downloading pauses,
+# which bounds the disk space used
+UPLOAD_BACKLOG = 100
+# Attempts at rsyncing each batch
+UPLOAD_TRIES = 3
+
+# Where we record the progress of each url, so we can resume after a crash
+JOURNAL_PATH = './tasks.sqlite'
+# Journal transitions are committed (and so fsynced) this many at a time...
+JOURNAL_COMMIT_BATCH = 50
+# ...or after this many seconds, whichever comes first
+JOURNAL_COMMIT_INTERVAL = 2
+
+# Batch caches from earlier versions, imported into the journal
+LEGACY_TASKS_CACHES = ['./tasks.json', './tasks-next.json']
+
+# Filenames sent to the control server per request
+REPORT_BATCH_SIZE = 200
+# Seconds between sending filename reports
+REPORT_INTERVAL = 10
+
+# How downloads are arranged on disk, see makeLayout
+STORAGE_LAYOUT = 'digits'
+# Tracks smaller than this are appended to pack files, 0 to never pack
+PACK_FILES_UNDER = 0
+# Packs are closed and shipped once they are this big
+PACK_SIZE = 1024 * 1024 * 256
+
+# Defaults for the download engine, override them in config.yaml
+# Tracks downloaded at once
+DOWNLOAD_CONCURRENCY = 8
+# Downloads at once from any one host, i.e. the CDN the API redirects them to
+PER_HOST_CONNECTIONS = 4
+# Total bytes per second across all downloads, 0 for no limit
+MAX_BANDWIDTH = 0
+
+# Where counters and timings are written, and how often
+METRICS_PATH = './metrics.json'
+METRICS_INTERVAL = 10
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300,
+                   float('inf')]
+
+################################################################################
+# Keep-alive connections, and directories
+################################################################################
+
+def ensureDirectory (path):
+    try:
+        os.makedirs(path)
+    except OSError, exception:
+        if exception.errno != errno.EEXIST:
+            raise
+
+def makeSession (pool_size):
+    """A session that keeps up to pool_size connections open to each host,
+       shared by all the download threads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+################################################################################
+# Metrics
+################################################################################
+
+# A copy of metrics.py from the crawler, as this is deployed as a single file
+
+class Histogram (object):
+
+    """Counts of observations falling in each bucket, plus their sum."""
+
+    def __init__ (self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe (self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def percentile (self, percent):
+        """The upper bound of the bucket the percentile falls in."""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot (self):
+        snapshot = {'count': self.count,
+                    'sum': round(self.sum, 6),
+                    'buckets': dict((str(bound), count)
+                                    for bound, count in zip(self.buckets,
+                                                            self.counts))}
+        if self.count:
+            snapshot['mean'] = round(self.sum / self.count, 6)
+            for percent in (50, 90, 99):
+                snapshot['p{0}'.format(percent)] = self.percentile(percent)
+        return snapshot
+
+class Timer (object):
+
+    """Observes how long its with block takes."""
+
+    def __init__ (self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__ (self):
+        self.started = time.time()
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.name, time.time() - self.started)
+        return False
+
+class Metrics (object):
+
+    """Thread-safe named counters, gauges and latency histograms, written to
+       a JSON file every interval seconds by a thread once started, so we can
+       see which stage is holding a VM back."""
+
+    def __init__ (self, path=METRICS_PATH, interval=METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started_at = time.time()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def count (self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge (self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def observe (self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def timer (self, name):
+        return Timer(self, name)
+
+    def snapshot (self):
+        with self.lock:
+            now = time.time()
+            return {'time': now,
+                    'uptime': round(now - self.started_at, 3),
+                    'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'latency': dict((name, histogram.snapshot())
+                                    for name, histogram
+                                    in self.histograms.items())}
+
+    def write (self):
+        """Write the snapshot, atomically so readers never see half of one."""
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            handle, temporary_path = tempfile.mkstemp(dir=directory,
+                                                      prefix='.metrics-')
+            with os.fdopen(handle, 'w') as snapshot_file:
+                json.dump(self.snapshot(), snapshot_file, indent=2,
+                          sort_keys=True)
+            os.rename(temporary_path, self.path)
+        except (IOError, OSError), exception:
+            print "Couldn't write metrics: {0}".format(exception)
+
+    def run (self):
+        while not self.stopping.wait(self.interval):
+            self.write()
+        self.write()
+
+    def start (self):
+        self.thread.start()
+
+    def finish (self):
+        self.stopping.set()
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+################################################################################
+# Limiting downloads
+################################################################################
+
+class BandwidthLimiter (object):
+
+    """A token bucket of bytes shared by all the download threads, to cap
+       their combined bandwidth. A rate of zero means no cap."""
+
+    def __init__ (self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def consume (self, size):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate,
+                                 self.allowance
+                                 + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            # Go into debt, then wait until it's paid off
+            self.allowance -= size
+            wait = max(0, -self.allowance / self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+class HostLimiter (object):
+
+    """Limits the number of downloads at once from each host. Downloads are
+       redirected from the API to the CDN, so take the semaphore for the url
+       redirected to, before connecting to it."""
+
+    def __init__ (self, connections):
+        self.connections = connections
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore (self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.connections)
+            return self.semaphores[host]
+
+################################################################################
+# Storage layouts
+################################################################################
+
+class DigitsLayout (object):
+
+    """One directory level per digit of the zero padded track id. This is
+       what we always used, so it is the default, but it costs ten directories
+       per file."""
+
+    def directory (self, track_id):
+        # Current max ids for SC are low 9 digits
+        return os.path.join(*list(track_id.zfill(10)))
+
+class HashedLayout (object):
+
+    """Two levels of 256 directories, picked by hashing the track id so they
+       fill evenly. At a few million tracks that is still only tens of files
+       per directory."""
+
+    def directory (self, track_id):
+        digest = hashlib.md5(track_id).hexdigest()
+        return os.path.join(digest[0:2], digest[2:4])
+
+STORAGE_LAYOUTS = {'digits': DigitsLayout,
+                   'hashed': HashedLayout}
+
+def makeLayout (name):
+    try:
+        return STORAGE_LAYOUTS[name]()
+    except KeyError:
+        raise ValueError("Unknown storage_layout {0}".format(name))
+
+class PackWriter (object):
+
+    """Appends small tracks to a pack file, and writes an index of where each
+       one is, so that many small tracks cost the file server one file. Each
+       index line is filename, offset and length, tab separated. A pack is
+       shipped once it reaches pack_size, and at the end of each batch.
+       Packs being written have the partial suffix, so they are never shipped
+       half done. If we crash, the tracks in them are downloaded again."""
+
+    def __init__ (self, config, uploader):
+        self.uploader = uploader
+        self.pack_directory = os.path.join(config['download_path'], 'packs')
+        self.files_under = config.get('pack_files_under', PACK_FILES_UNDER)
+        self.pack_size = config.get('pack_size', PACK_SIZE)
+        self.lock = threading.Lock()
+        self.pack_file = None
+
+    def accepts (self, filepath):
+        return self.files_under > 0 \
+            and os.path.getsize(filepath) < self.files_under
+
+    def open (self):
+        name = "{0}-{1}-{2}".format(socket.gethostname(), os.getpid(),
+                                    int(time.time() * 1000))
+        ensureDirectory(self.pack_directory)
+        self.pack_path = os.path.join(self.pack_directory, name + '.pack')
+        self.index_path = os.path.join(self.pack_directory, name + '.idx')
+        self.pack_file = open(self.pack_path + PARTIAL_SUFFIX, 'wb')
+        self.index_file = open(self.index_path + PARTIAL_SUFFIX, 'w')
+        self.task_ids = []
+
+    def close (self):
+        if self.pack_file is None:
+            return
+        self.pack_file.close()
+        self.index_file.close()
+        os.rename(self.pack_path + PARTIAL_SUFFIX, self.pack_path)
+        os.rename(self.index_path + PARTIAL_SUFFIX, self.index_path)
+        self.uploader.put(self.task_ids, [self.pack_path, self.index_path])
+        self.pack_file = None
+
+    def add (self, task_id, filepath):
+        with self.lock:
+            if self.pack_file is None:
+                self.open()
+            offset = self.pack_file.tell()
+            with open(filepath, 'rb') as track_file:
+                shutil.copyfileobj(track_file, self.pack_file, CHUNK_SIZE)
+            length = self.pack_file.tell() - offset
+            self.index_file.write("{0}\t{1}\t{2}\n".format(
+                os.path.basename(filepath), offset, length))
+            self.task_ids.append(task_id)
+            os.remove(filepath)
+            if self.pack_file.tell() >= self.pack_size:
+                self.close()
+
+    def finish (self):
+        with self.lock:
+            self.close()
+
+################################################################################
+# Journaling progress
+################################################################################
+
+# Each url goes through these states in order, or is skipped
+PENDING = 'pending'
+DOWNLOADING = 'downloading'
+DOWNLOADED = 'downloaded'
+UPLOADED = 'uploaded'
+REPORTED = 'reported'
+SKIPPED = 'skipped'
+
+# States in which there is still downloading or uploading to do
+UNFINISHED_STATES = (PENDING, DOWNLOADING, DOWNLOADED)
+
+JOURNAL_CREATES = [
+"""
+CREATE TABLE IF NOT EXISTS tasks (
+       task_id      INTEGER PRIMARY KEY,
+       batch_id     INTEGER NOT NULL,
+       download_url TEXT,
+       client_id    TEXT,
+       state        TEXT    NOT NULL,
+       track_id     TEXT,
+       filepath     TEXT,
+       filename     TEXT,
+       content_hash TEXT,
+       updated_at   REAL    NOT NULL
+);
+""","""
+CREATE INDEX IF NOT EXISTS tasks_batch_state_index ON tasks (batch_id, state);
+""","""
+CREATE INDEX IF NOT EXISTS tasks_state_index ON tasks (state);
+"""
+]
+
+# Columns added since the journal was first created
+JOURNAL_UPGRADES = [
+"""
+ALTER TABLE tasks ADD COLUMN content_hash TEXT;
+"""
+]
+
+class TaskJournal (object):
+
+    """An SQLite journal of the state of every url we have been given, so a
+       restarted worker carries on exactly where it stopped. Transitions are
+       committed in groups to keep fsyncs off the hot path, losing a few of
+       them in a crash is fine as downloads are resumable and idempotent.
+       Uploads are flushed at once, as their local files are gone."""
+
+    def __init__ (self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        for create in JOURNAL_CREATES:
+            self.connection.execute(create)
+        for upgrade in JOURNAL_UPGRADES:
+            try:
+                self.connection.execute(upgrade)
+            except sqlite3.OperationalError:
+                # Already done
+                pass
+        self.connection.commit()
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.committed_at = time.time()
+
+    def close (self):
+        self.flush()
+        self.connection.close()
+
+    def commitIfDue (self):
+        self.uncommitted += 1
+        if self.uncommitted >= JOURNAL_COMMIT_BATCH \
+           or time.time() - self.committed_at >= JOURNAL_COMMIT_INTERVAL:
+            self.commit()
+
+    def commit (self):
+        self.connection.commit()
+        self.uncommitted = 0
+        self.committed_at = time.time()
+
+    def flush (self):
+        with self.lock:
+            self.commit()
+
+    def addBatch (self, tasks_desc):
+        """Record a batch from the task server, returning its id."""
+        client_id = tasks_desc['config']['client_id']
+        with self.lock:
+            (batch_id,) = self.connection.execute(
+                "SELECT COALESCE(MAX(batch_id), 0) + 1 FROM tasks").fetchone()
+            now = time.time()
+            self.connection.executemany(
+                """INSERT OR IGNORE INTO tasks
+                       (task_id, batch_id, download_url, client_id, state,
+                        updated_at)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                [(int(task['id']), batch_id, task['download_url'], client_id,
+                  # Ignore empty download urls (download not enabled)
+                  PENDING if task['download_url'] else SKIPPED, now)
+                 for task in tasks_desc['urls']])
+            self.commit()
+        return batch_id
+
+    def unfinishedBatchCount (self):
+        with self.lock:
+            (count,) = self.connection.execute(
+                """SELECT COUNT(DISTINCT batch_id) FROM tasks
+                       WHERE state IN (?, ?, ?)""",
+                UNFINISHED_STATES).fetchone()
+        return count
+
+    def nextBatch (self):
+        """The unfinished tasks of the oldest unfinished batch."""
+        with self.lock:
+            rows = self.connection.execute(
+                """SELECT task_id, download_url, client_id, state, filepath,
+                          track_id, content_hash
+                       FROM tasks
+                       WHERE state IN (?, ?, ?)
+                         AND batch_id = (SELECT MIN(batch_id) FROM tasks
+                                             WHERE state IN (?, ?, ?))
+                       ORDER BY task_id""",
+                UNFINISHED_STATES + UNFINISHED_STATES).fetchall()
+        return [{'id': task_id, 'download_url': download_url,
+                 'client_id': client_id, 'state': state, 'filepath': filepath,
+                 'track_id': track_id, 'content_hash': content_hash}
+                for (task_id, download_url, client_id, state, filepath,
+                     track_id, content_hash) in rows]
+
+    def transition (self, task_id, state, **fields):
+        assignments = ''.join(', {0} = ?'.format(field) for field in fields)
+        with self.lock:
+            self.connection.execute(
+                """UPDATE tasks SET state = ?, updated_at = ?{0}
+                       WHERE task_id = ?""".format(assignments),
+                [state, time.time()] + fields.values() + [task_id])
+            self.commitIfDue()
+
+    def transitionMany (self, task_ids, state):
+        """Move several tasks on at once, committing immediately."""
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "UPDATE tasks SET state = ?, updated_at = ? WHERE task_id = ?",
+                [(state, now, task_id) for task_id in task_ids])
+            self.commit()
+
+    def unreported (self, limit):
+        """Uploaded tasks whose filenames the server doesn't know yet."""
+        with self.lock:
+            return self.connection.execute(
+                """SELECT task_id, track_id, filename FROM tasks
+                       WHERE state = ?
+                       ORDER BY task_id
+                       LIMIT ?""",
+                (UPLOADED, limit)).fetchall()
+
+    def purge (self):
+        """Forget tasks that are completely done."""
+        with self.lock:
+            self.connection.execute("DELETE FROM tasks WHERE state IN (?, ?)",
+                                    (REPORTED, SKIPPED))
+            self.commit()
+
+    def importLegacy (self):
+        """Bring in the batch caches left by earlier versions of the worker."""
+        for cache_path in LEGACY_TASKS_CACHES:
+            if os.path.exists(cache_path):
+                try:
+                    with open(cache_path, 'r') as json_cachefile:
+                        tasks_desc = json.loads(json_cachefile.read())
+                    if tasks_desc:
+                        self.addBatch(tasks_desc)
+                except ValueError:
+                    # Corrupt file
+                    pass
+                os.remove(cache_path)
+
 ################################################################################
-# Downloading and rsyncing tracks
+# Uploading tracks
+################################################################################
+
+class Uploader (object):
+
+    """A thread that rsyncs finished downloads to the file server in small
+       rolling batches while other tracks are still downloading. rsync removes
+       each local file once it has been transferred. If deduplicate is set,
+       the content hashes of each batch are first checked with the control
+       server, and tracks whose content it already has from another track are
+       recorded there as references to that track rather than uploaded."""
+
+    def __init__ (self, config, ssh_args, journal, session, metrics):
+        self.journal = journal
+        self.session = session
+        self.metrics = metrics
+        self.passkey = config['filename_insert_passkey']
+        self.insert_hashes_url = None
+        if config.get('deduplicate'):
+            self.insert_hashes_url = "{0}/{1}".format(config['control_server'],
+                                                      INSERT_HASHES_URL_PATH)
+        self.remote_path = config['rsync_remote_path']
+        self.rsync_path = config.get('rsync_path', RSYNC_PATH)
+        self.ssh_args = ssh_args
+        # We rsync paths relative to the download directory's parent, so files
+        # end up where rsyncing the whole download directory put them
+        self.source_path = os.path.dirname(
+            os.path.normpath(config['download_path']))
+        self.batch_size = config.get('upload_batch_size', UPLOAD_BATCH_SIZE)
+        self.queue = Queue.Queue(config.get('upload_backlog', UPLOAD_BACKLOG))
+        self.failed = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start (self):
+        self.thread.start()
+
+    def put (self, task_ids, filepaths, fingerprint=None):
+        """Queue files that complete the tasks, blocking if the backlog is
+           full. fingerprint is the (track_id, content_hash) of a single track
+           to check for duplicates."""
+        relpaths = [os.path.relpath(filepath, self.source_path)
+                    for filepath in filepaths]
+        fingerprints = []
+        if fingerprint and fingerprint[1]:
+            fingerprints.append((relpaths[0],) + tuple(fingerprint))
+        self.enqueue((task_ids, relpaths, fingerprints))
+
+    def enqueue (self, item):
+        """Put on the queue, but fail rather than wait forever for a thread
+           that has died."""
+        while True:
+            if not self.thread.is_alive():
+                raise IOError("Uploader has stopped")
+            try:
+                self.queue.put(item, timeout=UPLOAD_WAIT)
+                return
+            except Queue.Full:
+                pass
+
+    def finish (self):
+        """Ship everything that is queued, then stop."""
+        try:
+            self.enqueue(None)
+        finally:
+            while self.thread.is_alive():
+                self.thread.join(1)
+
+    def nextBatch (self):
+        """Wait for a file, then gather up to batch_size. None when finished."""
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                upload = self.queue.get(timeout=UPLOAD_WAIT)
+            except Queue.Empty:
+                break
+            if upload is None:
+                # Put it back so the next call stops
+                self.queue.put(None)
+                break
+            batch.append(upload)
+        return batch
+
+    def run (self):
+        while True:
+            batch = self.nextBatch()
+            if batch is None:
+                return
+            task_ids = []
+            relpaths = []
+            fingerprints = []
+            for (upload_task_ids, upload_relpaths, upload_fingerprints) in batch:
+                task_ids.extend(upload_task_ids)
+                relpaths.extend(upload_relpaths)
+                fingerprints.extend(upload_fingerprints)
+            self.metrics.gauge('upload_backlog', self.queue.qsize())
+            try:
+                uploaded = self.upload(task_ids, relpaths, fingerprints)
+            except Exception, exception:
+                # Keep going, or the download threads would wait on a full
+                # queue that nothing is emptying
+                print "Upload failed: {0}".format(exception)
+                self.metrics.count('upload_errors')
+                uploaded = False
+            if not uploaded:
+                self.failed.extend(relpaths)
+                self.metrics.count('upload_failed_files', len(relpaths))
+
+    def upload (self, task_ids, relpaths, fingerprints):
+        """Deduplicate and rsync a batch, returning whether it was shipped."""
+        with self.metrics.timer('deduplicate'):
+            relpaths = self.deduplicate(relpaths, fingerprints)
+        for attempt in range(UPLOAD_TRIES):
+            try:
+                with self.metrics.timer('upload'):
+                    uploaded = self.rsync(relpaths)
+                if uploaded:
+                    self.journal.transitionMany(task_ids, UPLOADED)
+                    self.metrics.count('files_uploaded', len(relpaths))
+                    return True
+            except (IOError, OSError), exception:
+                print "rsync failed: {0}".format(exception)
+            self.metrics.count('upload_errors')
+        return False
+
+    def deduplicate (self, relpaths, fingerprints):
+        """Register the batch's content hashes with the control server, and
+           drop the files it says are copies of other tracks."""
+        if not (self.insert_hashes_url and fingerprints):
+            return relpaths
+        hashes = [{'track_id': track_id, 'content_hash': content_hash}
+                  for (relpath, track_id, content_hash) in fingerprints]
+        try:
+            response = self.session.post(self.insert_hashes_url,
+                                         {'pass': self.passkey,
+                                          'hashes': json.dumps(hashes)})
+            response.raise_for_status()
+            canonical_ids = response.json()
+        except (requests.RequestException, ValueError), exception:
+            # Upload them all, we can deduplicate on the file server later
+            print "Couldn't check hashes: {0}".format(exception)
+            self.metrics.count('deduplicate_errors')
+            return relpaths
+        duplicates = set()
+        for (relpath, track_id, content_hash) in fingerprints:
+            canonical_id = canonical_ids.get(str(track_id))
+            if canonical_id is not None and str(canonical_id) != str(track_id):
+                print "{0} is a copy of {1}, not uploading.".format(
+                    track_id, canonical_id)
+                os.remove(os.path.join(self.source_path, relpath))
+                duplicates.add(relpath)
+        self.metrics.count('duplicates', len(duplicates))
+        return [relpath for relpath in relpaths if relpath not in duplicates]
+
+    def rsync (self, relpaths):
+        # Everything in the batch was a duplicate
+        if not relpaths:
+            return True
+        with tempfile.NamedTemporaryFile(delete=False) as files_from:
+            files_from.write("\n".join(relpaths) + "\n")
+        rsync_args = [self.rsync_path,
+                      '-e',
+                      self.ssh_args,
+                      '--files-from={0}'.format(files_from.name),
+                      '--remove-source-files',
+                      self.source_path,
+                      self.remote_path]
+        try:
+            return_code = subprocess.call(rsync_args)
+        finally:
+            os.remove(files_from.name)
+        if return_code == 0:
+            print "rsync OK ({0} files)".format(len(relpaths))
+        else:
+            print "rsync error {0}".format(return_code)
+        return return_code == 0
+
+################################################################################
+# Reporting filenames
+################################################################################
+
+class FilenameReporter (object):
+
+    """A thread that reports the original filenames of uploaded tracks to the
+       control server in batches. The journal keeps each filename until the
+       server has acknowledged it, so reports survive control server hiccups
+       and restarts."""
+
+    def __init__ (self, config, session, journal, metrics):
+        self.session = session
+        self.journal = journal
+        self.metrics = metrics
+        self.url = "{0}/{1}".format(config['control_server'],
+                                    INSERT_FILENAMES_URL_PATH)
+        self.passkey = config['filename_insert_passkey']
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start (self):
+        self.thread.start()
+
+    def finish (self):
+        """Stop, after trying to send everything. Anything unsent stays in the
+           journal for next time."""
+        self.stopping.set()
+        while self.thread.is_alive():
+            self.thread.join(1)
+
+    def send (self):
+        """Send a batch, returning False when there was nothing to send."""
+        rows = self.journal.unreported(REPORT_BATCH_SIZE)
+        if not rows:
+            return False
+        reports = [{'track_id': track_id, 'filename': filename}
+                   for (task_id, track_id, filename) in rows
+                   if filename]
+        if reports:
+            with self.metrics.timer('report'):
+                response = self.session.post(self.url,
+                                             {'pass': self.passkey,
+                                              'filenames': json.dumps(reports)})
+            response.raise_for_status()
+            self.metrics.count('filenames_reported', len(reports))
+        self.journal.transitionMany([task_id for (task_id, track_id, filename)
+                                     in rows],
+                                    REPORTED)
+        return True
+
+    def sendAll (self):
+        try:
+            while self.send():
+                pass
+        except requests.RequestException, exception:
+            print "Couldn't report filenames: {0}".format(exception)
+            self.metrics.count('report_errors')
+
+    def run (self):
+        while not self.stopping.wait(REPORT_INTERVAL):
+            self.sendAll()
+        self.sendAll()
+
+################################################################################
+# Downloading tracks
 ################################################################################
 
 class TasksWorker (object):
 
     """A class that loops through the urls in a task batch, fetches the files,
-       saves their filenames back to the database server, then rsyncs them
-       to the file server."""
+       records their filenames in the journal to report back to the database
+       server, and hands them to the Uploader to rsync to the file server.
+       Several files are fetched at once, each by its own thread. The journal
+       records each url's progress, and the batch may be one we were part way
+       through before a restart."""
 
-    def __init__ (self, config, tasks_desc):
+    def __init__ (self, config, tasks, session, journal, metrics):
+        self.session = session
+        self.journal = journal
+        self.metrics = metrics
         self.download_path = config['download_path']
-        self.remote_path = config['rsync_remote_path']
-        self.passkey = config['filename_insert_passkey']
-        self.client_id = tasks_desc['config']['client_id']
-        self.insert_filename_url = "{0}/{1}".format(config['control_server'],
-                                                    INSERT_FILENAME_URL_PATH)
-        self.urls = tasks_desc['urls']
-        self.ssh_args = SSH_ARGS.format(config['ssh_key_path'])
-        
+        self.tasks = tasks
+        self.uploader = Uploader(config,
+                                 SSH_ARGS.format(config['ssh_key_path']),
+                                 journal, session, metrics)
+        self.layout = makeLayout(config.get('storage_layout', STORAGE_LAYOUT))
+        self.packer = PackWriter(config, self.uploader)
+        self.concurrency = config.get('download_concurrency',
+                                      DOWNLOAD_CONCURRENCY)
+        self.host_limiter = HostLimiter(config.get('per_host_connections',
+                                                   PER_HOST_CONNECTIONS))
+        self.bandwidth_limiter = BandwidthLimiter(config.get('max_bandwidth',
+                                                             MAX_BANDWIDTH))
+
     def idToFilename (self, track_id):
         return track_id + '.mp3'
 
     def idToPath (self, track_id):
-        # Current max ids for SC are low 9 digits
-        return os.path.join(*list(track_id.zfill(10)))
+        return self.layout.directory(track_id)
 
-    def ensureDownloadDirs (self, path):
+    def hashFile (self, digest, filepath):
+        with open(filepath, 'rb') as existing_file:
+            for chunk in iter(lambda: existing_file.read(CHUNK_SIZE), ''):
+                digest.update(chunk)
+        return digest
+
+    def saveTrack (self, filepath, response, append=False):
+        """Save the track, returning the SHA-1 of its content, computed as it
+           streams so that it costs no extra reads. Unless we are resuming,
+           when we have to hash the part we already have."""
+        digest = hashlib.sha1()
+        if append:
+            self.hashFile(digest, filepath)
+        mode = 'ab' if append else 'wb'
+        downloaded = 0
         try:
-            os.makedirs(path)
-        except OSError, exception:
-            if exception.errno != errno.EEXIST:
+            with open(filepath, mode) as download_file:
+                # Avoid being Killed for running out of memory with big files on small VMs
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if chunk:
+                        self.bandwidth_limiter.consume(len(chunk))
+                        digest.update(chunk)
+                        download_file.write(chunk)
+                        downloaded += len(chunk)
+        finally:
+            self.metrics.count('bytes_downloaded', downloaded)
+        return digest.hexdigest()
+
+    @contextlib.contextmanager
+    def openTrack (self, url, client_id, resume_from=0):
+        """The streaming response for the track. The API redirects it to
+           the CDN, so the redirect is followed by hand, taking the host
+           limiter's semaphore before connecting to the CDN, and holding it
+           until the response is closed."""
+        url_with_client_id = "{0}?client_id={1}".format(url, client_id)
+        # We want the bytes as they are, so we can count and resume them
+        headers = {'Accept-Encoding': 'identity'}
+        if resume_from > 0:
+            headers['Range'] = 'bytes={0}-'.format(resume_from)
+        response = self.session.get(url_with_client_id, stream=True,
+                                    headers=headers, allow_redirects=False)
+        if response.is_redirect:
+            target = urlparse.urljoin(response.url,
+                                      response.headers['location'])
+            response.close()
+            semaphore = self.host_limiter.semaphore(target)
+            semaphore.acquire()
+            try:
+                response = self.session.get(target, stream=True,
+                                            headers=headers)
+            except:
+                semaphore.release()
                 raise
+        else:
+            # An error, or served by the API host itself
+            semaphore = self.host_limiter.semaphore(url)
+            semaphore.acquire()
+        try:
+            yield response
+        finally:
+            response.close()
+            semaphore.release()
+
+    def expectedSize (self, response):
+        """The size of the whole file, or None if the server doesn't say."""
+        if response.status_code == 206:
+            # e.g. bytes 1000-1999/2000
+            content_range = response.headers.get('content-range', '')
+            total = content_range.split('/')[-1]
+        else:
+            total = response.headers.get('content-length', '')
+        if total.isdigit():
+            return int(total)
+        return None
 
-    def saveTrack (self, filepath, response):
-        with open(filepath, 'wb') as download_file:
-            # Avoid being Killed for running out of memory with big files on small VMs
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    download_file.write(chunk)
+    def partialSize (self, partial_filepath):
+        if os.path.exists(partial_filepath):
+            return os.path.getsize(partial_filepath)
+        return 0
 
-    def fetchTrack (self, url):
-        url_with_client_id = "{0}?client_id={1}".format(url, self.client_id)
-        return requests.get(url_with_client_id, stream=True)
+    def process (self, url_id, url, client_id):
+        self.journal.transition(url_id, DOWNLOADING)
+        for attempt in range(1, DOWNLOAD_TRIES + 1):
+            try:
+                with self.metrics.timer('download'):
+                    downloaded = self.processTrack(url_id, url, client_id)
+                break
+            except (requests.RequestException, IOError), exception:
+                if attempt == DOWNLOAD_TRIES:
+                    raise
+                print "{0} retrying: {1}".format(url_id, exception)
+                self.metrics.count('download_retries')
+        if downloaded:
+            (filepath, track_id, content_hash) = downloaded
+            self.metrics.count('tracks_downloaded')
+            self.ship(url_id, filepath, track_id, content_hash)
+        else:
+            self.metrics.count('tracks_skipped')
+            self.journal.transition(url_id, SKIPPED)
 
-    def process (self, url_id, url):
+    def ship (self, task_id, filepath, track_id, content_hash):
+        """Upload a finished download, in a pack if it is small."""
+        if self.packer.accepts(filepath):
+            self.packer.add(task_id, filepath)
+        else:
+            self.uploader.put([task_id], [filepath], (track_id, content_hash))
+
+    def processTrack (self, url_id, url, client_id):
+        """Download the track, returning its path, id and content hash, or
+           None if we can't."""
         track_id = [item for item in url.split('/') if item != "" ][-2]
-        response = self.fetchTrack(url)
-        # Would be nice to differentiate between bad credentials and newly locked file.
-        # This is for the latter case.
-        if response.status_code == 401:
-            print "Couldn't access {0} (404), skipping.".format(url)
-            return
-        self.insertTrackFilename(track_id, response)
         file_directory = os.path.join(self.download_path,
                                       self.idToPath(track_id))
         filepath = os.path.join(file_directory, self.idToFilename(track_id))
-        self.ensureDownloadDirs(file_directory)
-        self.saveTrack (filepath, response)
-
-    def insertTrackFilename(self, url_id, response):
-        disposition = response.headers['content-disposition']
-        filename = re.findall("filename=(.+)", disposition)[0]
-        requests.post(self.insert_filename_url, {'pass':self.passkey,
-                                                 'track_id': url_id,
-                                                 'filename': filename})
-
-    def rsync (self):
-        rsync_args = ['/usr/bin/rsync',
-                      '-e',
-                      self.ssh_args,
-                      '-r',
-                      self.download_path,
-                      self.remote_path]
-        return_code = subprocess.call(rsync_args)
-        if return_code == 0:
-            print "rsync OK"
-        else:
-            print "rsync error {0}".format(return_code)
+        partial_filepath = filepath + PARTIAL_SUFFIX
+        resume_from = self.partialSize(partial_filepath)
+        with self.openTrack(url, client_id, resume_from) as response:
+            if response.status_code != 416:
+                return self.saveResponse(url_id, url, response, track_id,
+                                         filepath)
+        # Nothing left to fetch, or a changed file, so start again
+        os.remove(partial_filepath)
+        with self.openTrack(url, client_id) as response:
+            return self.saveResponse(url_id, url, response, track_id,
+                                     filepath)
+
+    def saveResponse (self, url_id, url, response, track_id, filepath):
+        partial_filepath = filepath + PARTIAL_SUFFIX
+        # Would be nice to differentiate between bad credentials and newly locked file.
+        # This is for the latter case, and for tracks that have since gone.
+        if response.status_code in (401, 404):
+            print "Couldn't access {0} ({1}), skipping.".format(
+                url, response.status_code)
+            self.metrics.count('download_status_{0}'.format(
+                response.status_code))
+            return None
+        response.raise_for_status()
+        expected_size = self.expectedSize(response)
+        filename = self.trackFilename(response)
+        # Downloaded but not uploaded before a restart
+        if os.path.exists(filepath) \
+           and os.path.getsize(filepath) == expected_size:
+            print "{0} already downloaded, skipping.".format(url_id)
+            response.close()
+            content_hash = self.hashFile(hashlib.sha1(), filepath).hexdigest()
+            self.journal.transition(url_id, DOWNLOADED, filepath=filepath,
+                                    track_id=track_id, filename=filename,
+                                    content_hash=content_hash)
+            return (filepath, track_id, content_hash)
+        ensureDirectory(os.path.dirname(filepath))
+        # The server may ignore the Range and send the whole file
+        content_hash = self.saveTrack(partial_filepath, response,
+                                      append=(response.status_code == 206))
+        # Leave short downloads to be resumed rather than shipping them
+        if expected_size is not None \
+           and self.partialSize(partial_filepath) != expected_size:
+            raise IOError("Incomplete download of {0}".format(url))
+        os.rename(partial_filepath, filepath)
+        self.journal.transition(url_id, DOWNLOADED, filepath=filepath,
+                                track_id=track_id, filename=filename,
+                                content_hash=content_hash)
+        return (filepath, track_id, content_hash)
+
+    def trackFilename(self, response):
+        """The track's original filename, or None if the server doesn't say."""
+        disposition = response.headers.get('content-disposition', '')
+        filenames = re.findall("filename=(.+)", disposition)
+        if filenames:
+            return filenames[0]
+        return None
 
     def cleanup (self):
         shutil.rmtree(self.download_path)
 
+    def downloadLoop (self, queue, errors):
+        while True:
+            try:
+                (task_id, download_url, client_id) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.process(task_id, download_url, client_id)
+            except Exception, exception:
+                print "{0} error: {1}".format(task_id, exception)
+                self.metrics.count('download_errors')
+                errors.append(exception)
+
+    def downloadAll (self, queue):
+        errors = []
+        threads = [threading.Thread(target=self.downloadLoop,
+                                    args=(queue, errors))
+                   for thread_number in range(min(self.concurrency,
+                                                  queue.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # Join with a timeout so we can still be interrupted
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+        # Fail the batch, as we did when downloading one at a time, so it
+        # will be retried
+        if errors:
+            raise errors[0]
+
     def serviceTasks(self):
-        for task in self.urls:
-            task_id = task['id']
-            download_url = task['download_url']
-            # Ignore empty download urls (download not enabled
-            if download_url:
-                print "{0} {1}".format(task_id, download_url)
-                self.process(task_id, download_url)
-            else:
-                print "{0} NO DOWNLOAD.".format(task_id)
+        queue = Queue.Queue()
+        self.uploader.start()
+        try:
+            for task in self.tasks:
+                task_id = task['id']
+                download_url = task['download_url']
+                filepath = task['filepath']
+                # Downloaded but not uploaded before a restart
+                if task['state'] == DOWNLOADED and filepath \
+                   and os.path.exists(filepath):
+                    print "{0} UPLOAD {1}".format(task_id, filepath)
+                    self.ship(task_id, filepath, task['track_id'],
+                              task['content_hash'])
+                else:
+                    print "{0} {1}".format(task_id, download_url)
+                    queue.put((task_id, download_url, task['client_id']))
+            self.downloadAll(queue)
+        finally:
+            try:
+                self.packer.finish()
+                self.uploader.finish()
+            finally:
+                self.journal.flush()
+        # Keep the batch, and the files we couldn't ship, to retry
+        if self.uploader.failed:
+            raise IOError("Couldn't rsync {0} files".format(
+                len(self.uploader.failed)))
         # This will be false if no tracks in the batch were downloadable
         if os.path.exists(self.download_path):
-            self.rsync()
             self.cleanup()
 
 ################################################################################
 # Fetching tasks from the data server and servicing them
 ################################################################################
 
+class TasksUnavailable (Exception):
+
+    """The tasks feed failed in a way worth trying again."""
+
+    pass
+
 class Worker (object):
 
     """A class that loops, fetching batches of urls from the data server,
-       and working on them."""
+       and working on them. The next batch is fetched while the current one
+       is worked on."""
 
     def __init__ (self, config):
         self.config = config
         self.control_server = config['control_server']
+        self.session = makeSession(config.get('http_pool_size',
+                                              config.get('download_concurrency',
+                                                         DOWNLOAD_CONCURRENCY)))
+        self.journal = TaskJournal(config.get('journal_path', JOURNAL_PATH))
+        self.journal.importLegacy()
+        self.metrics = Metrics(config.get('metrics_path', METRICS_PATH))
+        self.reporter = FilenameReporter(config, self.session, self.journal,
+                                         self.metrics)
+        # The task feed, or fetch-tasks.php
+        self.tasks_url = config.get('tasks_url',
+                                    "%s/%s" % (self.control_server,
+                                               TASKS_REQUEST_URL_PATH))
+        self.tasks_quantity = config.get('tasks_quantity')
+        self.prefetch_thread = None
 
-    def jsonConfigCacheFilepath (self):
-        return './tasks.json'
-    
-    def restorePreviousTaskConfig (self):
+    def requestTasks (self):
+        """The feed's next batch, or None if it has no more tasks. Raises
+           TasksUnavailable for errors worth trying again."""
+        params = {}
+        if self.tasks_quantity:
+            params['quantity'] = self.tasks_quantity
         try:
-            with open(self.jsonConfigCacheFilepath(), 'r') as json_cachefile:
-                config = json.loads(json_cachefile.read())
-        except:
-            # Absent or corrupt file
-            config = False
-        return config
-
-    def fetchNewTaskConfig (self):
-        response = requests.get("%s/%s" % (self.control_server,
-                                           TASKS_REQUEST_URL_PATH))
+            with self.metrics.timer('fetch_tasks'):
+                response = self.session.get(self.tasks_url, params=params)
+        except requests.RequestException, exception:
+            raise TasksUnavailable(exception)
         print "GET tasks. HTTP response code: {0}".format(response.status_code)
-        with open(self.jsonConfigCacheFilepath(), 'w') as json_cachefile:
-            print >>json_cachefile, response.text
-        return json.loads(response.text)
+        if response.status_code == 404:
+            return None
+        # e.g. the feed couldn't get the lock on the offsets, or the database
+        if response.status_code >= 500:
+            raise TasksUnavailable("HTTP {0}".format(response.status_code))
+        response.raise_for_status()
+        try:
+            tasks_desc = json.loads(response.text)
+            tasks_desc['urls']
+        except (ValueError, TypeError, KeyError), exception:
+            raise TasksUnavailable("Bad response: {0}".format(exception))
+        return tasks_desc
+
+    def fetchNewTasks (self):
+        """Fetch a batch into the journal, returning False if there are none.
+           Errors from the feed are waited out and the request tried again,
+           only a 404 means there are no more tasks."""
+        delay = TASKS_RETRY_DELAY
+        while True:
+            try:
+                tasks_desc = self.requestTasks()
+                break
+            except TasksUnavailable, exception:
+                print "Couldn't get tasks, trying again in {0} seconds: {1}" \
+                    .format(delay, exception)
+                self.metrics.count('fetch_tasks_errors')
+                time.sleep(delay)
+                delay = min(MAX_TASKS_RETRY_DELAY, delay * 2)
+        if not tasks_desc:
+            return False
+        self.journal.addBatch(tasks_desc)
+        self.metrics.count('tasks_fetched', len(tasks_desc['urls']))
+        return True
 
-    def workOnTasks (self, config, tasks_desc):
-        tasks_worker = TasksWorker(config, tasks_desc)
+    def prefetch (self):
+        """Fetch the next batch into the journal in the background."""
+        def fetch ():
+            try:
+                self.fetchNewTasks()
+            except Exception, exception:
+                # We'll fetch it when we need it instead
+                print "Couldn't prefetch tasks: {0}".format(exception)
+        self.prefetch_thread = threading.Thread(target=fetch)
+        self.prefetch_thread.daemon = True
+        self.prefetch_thread.start()
+
+    def waitForPrefetch (self):
+        while self.prefetch_thread and self.prefetch_thread.is_alive():
+            self.prefetch_thread.join(1)
+
+    def workOnTasks (self, config, tasks):
+        tasks_worker = TasksWorker(config, tasks, self.session, self.journal,
+                                   self.metrics)
         tasks_worker.serviceTasks()
 
     def work (self):
-        while True:
-            tasks_desc = self.restorePreviousTaskConfig()
-            if not tasks_desc:
-                tasks_desc = self.fetchNewTaskConfig()
-            if (not tasks_desc) or len(tasks_desc) < 0:
-                break
-            print "First id: {0}".format(tasks_desc['urls'][0]['id'])
-            self.workOnTasks(self.config, tasks_desc)
-            os.remove(self.jsonConfigCacheFilepath())
+        self.metrics.start()
+        # Also sends anything left unacknowledged from the last run
+        self.reporter.start()
+        try:
+            while True:
+                # Carries on from where we were before a restart
+                tasks = self.journal.nextBatch()
+                if not tasks:
+                    if not self.fetchNewTasks():
+                        break
+                    continue
+                print "First id: {0}".format(tasks[0]['id'])
+                if self.journal.unfinishedBatchCount() < 2:
+                    self.prefetch()
+                self.workOnTasks(self.config, tasks)
+                self.journal.purge()
+                self.waitForPrefetch()
+        finally:
+            self.reporter.finish()
+            self.journal.close()
+            self.metrics.finish()
 
 ################################################################################
 # Main flow of control